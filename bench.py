@@ -0,0 +1,509 @@
+"""Нагрузочный стенд: тысячи синтетических пользователей проходят анкету.
+
+Хендлеры bot.py работают по-настоящему, но Bot API подменён локальным
+aiohttp-сервером, а лист Google Sheets — заглушкой в памяти. Задержки и ошибки
+обеих сторон настраиваются флагами.
+
+    python bench.py --users 2000 --concurrency 500
+    python bench.py --users 2000 --save main        # сохранить базовую линию
+    python bench.py --users 2000 --compare main     # сравнить с ней
+
+Прогон завершается с кодом 1, если холодный старт дольше COLD_START_TARGET из bot.py
+(или --cold-start-target).
+
+Отдельная проверка холодного старта, когда Google Sheets не отвечает совсем
+(код 1, если старт не уложился в цель):
+
+    python bench.py --cold-start-check
+
+Заглушку Bot API можно поднять и отдельным сервисом (так её запускает docker-compose):
+
+    python bench.py --serve-fake-telegram --host 0.0.0.0 --port 8081
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from aiohttp import web
+
+BASELINES_DIR = Path(__file__).resolve().parent / "bench_baselines"
+BENCH_TOKEN = "123456:BENCH"
+BENCH_ADMIN_IDS = (900001, 900002)
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# --- Заглушка Bot API ---
+class FakeTelegram:
+    """Отвечает на любые методы Bot API и запоминает последнюю клавиатуру в каждом чате."""
+
+    def __init__(self, latency: float, error_rate: float, retry_after_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after_rate = retry_after_rate
+        self.calls: dict[str, int] = {}
+        self.keyboards: dict[int, tuple[int, list[str]]] = {}
+        self._message_id = 0
+        self._file_id = 0
+
+    def _message(self, chat_id: int, fields: dict) -> dict:
+        self._message_id += 1
+        message = {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": fields.get("text") or fields.get("caption") or "",
+        }
+        markup = fields.get("reply_markup")
+        if markup:
+            buttons = [b["callback_data"] for row in json.loads(markup)["inline_keyboard"] for b in row]
+            self.keyboards[chat_id] = (self._message_id, buttons)
+        return message
+
+    def _file(self) -> dict:
+        self._file_id += 1
+        return {"file_id": f"file-{self._file_id}", "file_unique_id": f"u{self._file_id}"}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        fields = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(random.uniform(0.5, 1.5) * self.latency)
+        roll = random.random()
+        if roll < self.retry_after_rate:
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        if roll < self.retry_after_rate + self.error_rate:
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+        chat_id = int(fields.get("chat_id") or 0)
+        if method == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendmessage", "editmessagetext"):
+            result = self._message(chat_id, fields)
+        elif method == "sendphoto":
+            result = self._message(chat_id, fields)
+            result["photo"] = [dict(self._file(), width=1, height=1)]
+        elif method == "senddocument":
+            result = self._message(chat_id, fields)
+            result["document"] = self._file()
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> tuple[web.AppRunner, str]:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return runner, f"http://{host}:{port}"
+
+
+async def serve_fake_telegram(host: str, port: int) -> None:
+    """Заглушка Bot API без задержек и ошибок; работает, пока процесс не остановят."""
+    runner, url = await FakeTelegram(0.0, 0.0, 0.0).start(host, port)
+    print(f"Заглушка Bot API слушает {url}", file=sys.stderr, flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+# --- Заглушка таблицы Google Sheets ---
+def _parse_range(a1_range: str) -> tuple[str, int]:
+    """"'Лиды 2026-10'!A5:G5" -> ("Лиды 2026-10", 5)"""
+    title, _, cells = a1_range.rpartition("!")
+    title = title[1:-1].replace("''", "'") if title.startswith("'") else title
+    return title, int(cells.split(":")[0].lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ") or 1)
+
+
+class FakeSpreadsheet:
+    """Таблица в памяти; вызовы идут из потока, как у gspread."""
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = 0
+        self.sheets: dict[str, FakeWorksheet] = {"Лист1": FakeWorksheet(self, "Лист1")}
+
+    def _call(self) -> None:
+        self.calls += 1
+        if self.latency:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency)
+        if random.random() < self.error_rate:
+            raise ConnectionError("fake sheets error")
+
+    @property
+    def rows(self) -> int:
+        return sum(len(ws.rows) for ws in self.sheets.values())
+
+    def worksheets(self) -> list:
+        self._call()
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title: str, rows: int, cols: int, index=None):
+        self._call()
+        ws = self.sheets[title] = FakeWorksheet(self, title)
+        return ws
+
+    def values_batch_get(self, ranges: list[str], params=None) -> dict:
+        self._call()
+        result = []
+        for a1_range in ranges:
+            title, _ = _parse_range(a1_range + "!A1")
+            rows = self.sheets[title].rows
+            result.append({"range": a1_range, "values": [[str(v) for v in row] for row in rows]} if rows else {"range": a1_range})
+        return {"valueRanges": result}
+
+    def values_batch_update(self, body: dict) -> dict:
+        self._call()
+        for item in body["data"]:
+            title, row = _parse_range(item["range"])
+            rows = self.sheets[title].rows
+            while len(rows) < row:
+                rows.append([])
+            rows[row - 1] = list(item["values"][0])
+        return {}
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet: FakeSpreadsheet, title: str):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.rows: list[list] = []
+
+    def row_values(self, index: int) -> list:
+        self.spreadsheet._call()
+        return self.rows[index - 1] if len(self.rows) >= index else []
+
+    def update(self, range_name: str, values: list) -> dict:
+        self.spreadsheet._call()
+        if range_name.startswith("A1:"):
+            if self.rows:
+                self.rows[0] = list(values[0])
+            else:
+                self.rows.append(list(values[0]))
+        return {}
+
+    def append_rows(self, rows: list, **kwargs) -> dict:
+        self.spreadsheet._call()
+        start = len(self.rows) + 1
+        self.rows.extend(rows)
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:G{len(self.rows)}"}}
+
+
+# --- Синтетический пользователь ---
+class SyntheticUser:
+    def __init__(self, bot, dp, telegram: FakeTelegram, user_id: int, think_time: float,
+                 latencies: dict[str, list[float]]):
+        self.bot = bot
+        self.dp = dp
+        self.telegram = telegram
+        self.user_id = user_id
+        self.think_time = think_time
+        self.latencies = latencies
+        self._update_id = user_id * 100
+
+    def _user(self):
+        from aiogram.types import User
+        return User(id=self.user_id, is_bot=False, first_name=f"User{self.user_id}", username=f"user{self.user_id}")
+
+    def _chat(self):
+        from aiogram.types import Chat
+        return Chat(id=self.user_id, type="private")
+
+    async def _feed(self, step: str, **payload) -> None:
+        from aiogram.types import Update
+        self._update_id += 1
+        update = Update(update_id=self._update_id, **payload)
+        started = time.perf_counter()
+        await self.dp.feed_update(self.bot, update)
+        self.latencies.setdefault(step, []).append(time.perf_counter() - started)
+        if self.think_time:
+            await asyncio.sleep(random.uniform(0, self.think_time))
+
+    async def send_text(self, step: str, text: str) -> None:
+        from aiogram.types import Message
+        message = Message(message_id=0, date=datetime.now(), chat=self._chat(), from_user=self._user(), text=text)
+        await self._feed(step, message=message.as_(self.bot))
+
+    async def press_button(self, step: str) -> bool:
+        from aiogram.types import CallbackQuery, Message
+        keyboard = self.telegram.keyboards.get(self.user_id)
+        if not keyboard:
+            return False
+        message_id, buttons = keyboard
+        message = Message(message_id=message_id, date=datetime.now(), chat=self._chat(), text="")
+        query = CallbackQuery(id=f"{self.user_id}-{step}", from_user=self._user(), chat_instance="bench",
+                              message=message, data=random.choice(buttons))
+        await self._feed(step, callback_query=query.as_(self.bot))
+        return True
+
+    async def run(self) -> bool:
+        await self.send_text("start", "/start")
+        await self.send_text("name", f"Пользователь {self.user_id}")
+        for step in ("budget", "goal", "timing"):
+            if not await self.press_button(step):
+                return False
+        await self.send_text("phone", f"+7999{self.user_id % 10_000_000:07d}")
+        return True
+
+
+async def _loop_lag_monitor(samples: list[float], stop: asyncio.Event, interval: float = 0.01) -> None:
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+async def run_bench(args) -> dict:
+    # bot.py ищет data/ и pdf_config.json относительно рабочего каталога
+    os.chdir(Path(__file__).resolve().parent)
+    workdir = Path(tempfile.mkdtemp(prefix="bench-"))
+    os.environ.update({
+        "TELEGRAM_TOKEN": BENCH_TOKEN,
+        "LEAD_STORE_PATH": str(workdir / "leads.sqlite3"),
+        "MEDIA_CACHE_PATH": str(workdir / "media_cache.json"),
+        "METRICS_PORT": "0",
+        "ADMIN_IDS": ",".join(str(i) for i in BENCH_ADMIN_IDS),
+        "PARTIAL_SAVE_TIMEOUT": str(args.partial_timeout),
+        "SHEET_RETRY_BASE_DELAY": "0.05",
+        # Синтетические пользователи отвечают без пауз: антифлуд не должен их резать
+        "THROTTLE_USER_BURST": "1000",
+        "THROTTLE_GLOBAL_RATE": "1000000",
+        "THROTTLE_GLOBAL_BURST": "1000000",
+        # Лимиты исходящих запросов — на порядки выше реальных, но очередь работает
+        "SEND_GLOBAL_RATE": "1000000",
+        "SEND_GLOBAL_BURST": "1000000",
+        "SEND_PER_CHAT_RATE": "1000",
+        "SEND_PER_CHAT_BURST": "1000",
+    })
+    telegram = FakeTelegram(args.tg_latency, args.tg_error_rate, args.tg_retry_after_rate)
+    tg_runner, tg_url = await telegram.start()
+    os.environ["TELEGRAM_API_URL"] = tg_url
+
+    # Холодный старт: импорт модуля и запуск фоновых сервисов
+    cold_started = time.perf_counter()
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import bot as bot_module
+    # Построчный лог каждого обновления сам по себе заметно тормозит прогон
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    spreadsheet = FakeSpreadsheet(args.sheets_latency, args.sheets_error_rate)
+    bot_module.tenants.get(bot_module.DEFAULT_TENANT).sheets = bot_module.SheetsClient(opener=lambda: spreadsheet)
+    bot = bot_module.create_bots()[0]
+    dp = bot_module.build_dispatcher()
+    await bot_module.start_services()
+    cold_start = time.perf_counter() - cold_started
+
+    latencies: dict[str, list[float]] = {}
+    lag_samples: list[float] = []
+    stop_monitor = asyncio.Event()
+    monitor = asyncio.create_task(_loop_lag_monitor(lag_samples, stop_monitor))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    completed = 0
+
+    async def one(user_id: int) -> None:
+        nonlocal completed
+        async with semaphore:
+            user = SyntheticUser(bot, dp, telegram, user_id, args.think_time, latencies)
+            try:
+                if await user.run():
+                    completed += 1
+            except Exception as exc:
+                latencies.setdefault("errors", []).append(0.0)
+                if args.verbose:
+                    print(f"user {user_id}: {exc!r}", file=sys.stderr)
+
+    rss_before = _rss_bytes()
+    started = time.perf_counter()
+    await asyncio.gather(*(one(1_000_000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+    rss_after = _rss_bytes()
+
+    # Дожидаемся, пока очереди доедут до заглушек
+    drain_started = time.perf_counter()
+    await bot_module.stop_services()
+    drain = time.perf_counter() - drain_started
+    stop_monitor.set()
+    await monitor
+    await bot.session.close()
+    await tg_runner.cleanup()
+
+    updates = sum(len(v) for k, v in latencies.items() if k != "errors")
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "params": {k: v for k, v in vars(args).items() if k not in ("save", "compare", "verbose")},
+        "cold_start_s": round(cold_start, 4),
+        "cold_start_target_s": args.cold_start_target or bot_module.COLD_START_TARGET,
+        "elapsed_s": round(elapsed, 3),
+        "drain_s": round(drain, 3),
+        "users_completed": completed,
+        "user_errors": len(latencies.get("errors", [])),
+        "throughput_updates_per_s": round(updates / elapsed, 1) if elapsed else 0.0,
+        "throughput_users_per_s": round(completed / elapsed, 1) if elapsed else 0.0,
+        "handler_latency_ms": {
+            step: {"p50": round(_percentile(v, 0.5) * 1000, 2), "p99": round(_percentile(v, 0.99) * 1000, 2),
+                   "mean": round(statistics.fmean(v) * 1000, 2)}
+            for step, v in latencies.items() if step != "errors"
+        },
+        "loop_lag_ms": {"p50": round(_percentile(lag_samples, 0.5) * 1000, 2),
+                        "p99": round(_percentile(lag_samples, 0.99) * 1000, 2),
+                        "max": round(max(lag_samples, default=0.0) * 1000, 2)},
+        "rss_growth_mb": round((rss_after - rss_before) / 2**20, 2),
+        "sheet_rows": spreadsheet.rows,
+        "sheet_tabs": {title: len(ws.rows) for title, ws in spreadsheet.sheets.items()},
+        "telegram_calls": telegram.calls,
+    }
+
+
+async def cold_start_check(target: float | None) -> dict:
+    """Старт бота, когда подключение к таблице не завершается никогда: бот не должен его ждать."""
+    os.chdir(Path(__file__).resolve().parent)
+    workdir = Path(tempfile.mkdtemp(prefix="bench-"))
+    os.environ.update({
+        "TELEGRAM_TOKEN": BENCH_TOKEN,
+        "LEAD_STORE_PATH": str(workdir / "leads.sqlite3"),
+        "MEDIA_CACHE_PATH": str(workdir / "media_cache.json"),
+        "METRICS_PORT": "0",
+    })
+    tg_runner, tg_url = await FakeTelegram(0.0, 0.0, 0.0).start()
+    os.environ["TELEGRAM_API_URL"] = tg_url
+
+    cold_started = time.perf_counter()
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    import bot as bot_module
+    # Открытие таблицы висит в потоке, пока проверка его не отпустит
+    hang = threading.Event()
+    bot_module.tenants.get(bot_module.DEFAULT_TENANT).sheets = bot_module.SheetsClient(opener=hang.wait)
+    if target is None:
+        target = bot_module.COLD_START_TARGET
+    bot = bot_module.create_bots()[0]
+    bot_module.build_dispatcher()
+    try:
+        # Если старт всё же ждёт таблицу, проверка должна упасть, а не зависнуть
+        await asyncio.wait_for(bot_module.start_services(), target + 1)
+    except asyncio.TimeoutError:
+        pass
+    cold_start = time.perf_counter() - cold_started
+    sheets_ready = bot_module.tenants.get(bot_module.DEFAULT_TENANT).sheets.ready
+
+    await bot_module.stop_services()
+    hang.set()
+    await bot.session.close()
+    await tg_runner.cleanup()
+    return {
+        "cold_start_s": round(cold_start, 4),
+        "cold_start_target_s": target,
+        "sheets_ready": sheets_ready,
+    }
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list[str]:
+    """Сравнивает прогон с базовой линией; возвращает список регрессий."""
+    regressions = []
+
+    def check(name: str, current: float, base: float, higher_is_better: bool) -> None:
+        if not base:
+            return
+        change = (current - base) / base
+        worse = -change if higher_is_better else change
+        marker = "РЕГРЕССИЯ" if worse > max_regression else "ok"
+        print(f"  {name:<40} {base:>10} -> {current:>10} ({change:+.1%}) {marker}")
+        if worse > max_regression:
+            regressions.append(name)
+
+    check("throughput_updates_per_s", result["throughput_updates_per_s"], baseline["throughput_updates_per_s"], True)
+    check("loop_lag_ms.p99", result["loop_lag_ms"]["p99"], baseline["loop_lag_ms"]["p99"], False)
+    check("cold_start_s", result["cold_start_s"], baseline["cold_start_s"], False)
+    for step, stats in result["handler_latency_ms"].items():
+        base = baseline["handler_latency_ms"].get(step)
+        if base:
+            check(f"handler_latency_ms.{step}.p99", stats["p99"], base["p99"], False)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000, help="сколько пользователей проходят анкету")
+    parser.add_argument("--concurrency", type=int, default=500, help="сколько пользователей одновременно")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза пользователя между шагами, с")
+    parser.add_argument("--partial-timeout", type=int, default=600, help="PARTIAL_SAVE_TIMEOUT на время прогона")
+    parser.add_argument("--tg-latency", type=float, default=0.01, help="задержка ответа Bot API, с")
+    parser.add_argument("--tg-error-rate", type=float, default=0.0, help="доля ответов 500 от Bot API")
+    parser.add_argument("--tg-retry-after-rate", type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="задержка запроса к таблице, с")
+    parser.add_argument("--sheets-error-rate", type=float, default=0.0, help="доля ошибок таблицы")
+    parser.add_argument("--save", metavar="NAME", help="сохранить результат как базовую линию NAME")
+    parser.add_argument("--compare", metavar="NAME", help="сравнить с базовой линией NAME")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="допустимое ухудшение (доля)")
+    parser.add_argument("--cold-start-target", type=float, help="цель по холодному старту, с (по умолчанию COLD_START_TARGET)")
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--cold-start-check", action="store_true",
+                        help="только проверить холодный старт при неотвечающей Google Sheets")
+    parser.add_argument("--serve-fake-telegram", action="store_true",
+                        help="не гонять анкету, а только поднять заглушку Bot API на --host:--port")
+    parser.add_argument("--host", default="127.0.0.1", help="адрес заглушки Bot API для --serve-fake-telegram")
+    parser.add_argument("--port", type=int, default=8081, help="порт заглушки Bot API для --serve-fake-telegram")
+    args = parser.parse_args()
+
+    if args.serve_fake_telegram:
+        asyncio.run(serve_fake_telegram(args.host, args.port))
+        return 0
+    if args.cold_start_check:
+        result = asyncio.run(cold_start_check(args.cold_start_target))
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+        if result["cold_start_s"] > result["cold_start_target_s"]:
+            print(f"\nХолодный старт {result['cold_start_s']} с — больше цели {result['cold_start_target_s']} с",
+                  file=sys.stderr)
+            return 1
+        return 0
+
+    result = asyncio.run(run_bench(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    exit_code = 0
+    if result["cold_start_s"] > result["cold_start_target_s"]:
+        print(f"\nХолодный старт {result['cold_start_s']} с — больше цели {result['cold_start_target_s']} с", file=sys.stderr)
+        exit_code = 1
+    if args.compare:
+        baseline = json.loads((BASELINES_DIR / f"{args.compare}.json").read_text(encoding="utf-8"))
+        print(f"\nСравнение с базовой линией '{args.compare}' ({baseline['timestamp']}):")
+        if compare(result, baseline, args.max_regression):
+            exit_code = 1
+    if args.save:
+        BASELINES_DIR.mkdir(exist_ok=True)
+        (BASELINES_DIR / f"{args.save}.json").write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"\nБазовая линия сохранена: {BASELINES_DIR / (args.save + '.json')}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,45 @@
 
+import time
+# Момент запуска процесса — для замера холодного старта
+STARTED_AT = time.monotonic()
+
 import asyncio
-from aiogram import Bot, Dispatcher, F
+from aiogram import Bot, Dispatcher, F, BaseMiddleware
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
+from aiogram.methods import SendDocument
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
  
 from pathlib import Path
 import re
 import os
+import signal
 import json
+import hashlib
+import tempfile
+import html
+import zlib
+import heapq
+import bisect
+import itertools
+import functools
+import contextvars
+import socket
+import uuid
+from collections import OrderedDict
+import sqlite3
+import threading
+import asyncpg
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
  
@@ -20,44 +49,1246 @@ from dotenv import load_dotenv
 # --- Загрузка .env ---
 load_dotenv()
 
+# --- Метрики (формат Prometheus) ---
+# Счётчики обновляются в памяти без блокировок; текст для /metrics собирается только при запросе.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))  # 0 — не поднимать /metrics
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    async def render(self) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in self._values.items()]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [счётчики по корзинам + корзина +Inf, сумма]
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    async def render(self) -> list[str]:
+        lines = []
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames + ('le',), labels + (bound,))} {cumulative}")
+            base = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{base} {total}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+class Gauge:
+    """Значение снимается при запросе /metrics; функция может быть корутиной."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn):
+        self.name = name
+        self.help_text = help_text
+        self.fn = fn
+
+    async def render(self) -> list[str]:
+        try:
+            value = self.fn()
+            if asyncio.iscoroutine(value):
+                value = await value
+        except Exception:
+            logging.debug("Метрика %s недоступна", self.name, exc_info=True)
+            return []
+        return [f"{self.name} {value}"]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    async def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(await metric.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_LATENCY = metrics.register(Histogram("bot_handler_duration_seconds", "Время работы хендлера", ("handler",)))
+HANDLER_ERRORS = metrics.register(Counter("bot_handler_errors_total", "Исключения в хендлерах", ("handler",)))
+TELEGRAM_LATENCY = metrics.register(Histogram("telegram_api_duration_seconds", "Время запросов к Bot API", ("method",)))
+TELEGRAM_ERRORS = metrics.register(Counter("telegram_api_errors_total", "Ошибки запросов к Bot API", ("method", "error")))
+SHEETS_LATENCY = metrics.register(Histogram("sheets_api_duration_seconds", "Время запросов к Google Sheets", ("operation",)))
+SHEETS_ERRORS = metrics.register(Counter("sheets_api_errors_total", "Ошибки запросов к Google Sheets", ("operation",)))
+SHEETS_ROWS = metrics.register(Counter("sheets_rows_total", "Строки, записанные в таблицу или не доставленные", ("result",)))
+SURVEY_STEPS = metrics.register(Counter("survey_steps_total", "Пройденные шаги анкеты", ("tenant", "funnel", "step")))
+LEADS_SAVED = metrics.register(Counter("leads_saved_total", "Лиды, записанные в локальное хранилище", ("tenant", "kind")))
+THROTTLED_UPDATES = metrics.register(Counter("updates_throttled_total", "Обновления, отброшенные антифлудом", ("scope",)))
+SUPPRESSED_ERRORS = metrics.register(Counter("suppressed_errors_total", "Ошибки, после которых бот продолжает работу", ("site",)))
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Время и ошибки каждого хендлера; подключается как inner-middleware."""
+
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = getattr(handler_obj.callback, "__name__", "unknown") if handler_obj else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Время и ошибки запросов к Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as exc:
+            TELEGRAM_ERRORS.inc(name, type(exc).__name__)
+            raise
+        finally:
+            TELEGRAM_LATENCY.observe(time.perf_counter() - started, name)
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=await metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server() -> web.AppRunner | None:
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
 # --- Настройка Google Sheets ---
 SHEET_ID = os.getenv("SHEET_ID")
 SCOPES = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
 CREDS_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "creds.json")
-CREDS = ServiceAccountCredentials.from_json_keyfile_name(CREDS_FILE, SCOPES)
-client = gspread.authorize(CREDS)
-spreadsheet = client.open_by_key(SHEET_ID)
-sheet = spreadsheet.sheet1
+# Пауза между попытками подключиться к таблице, если Google недоступен
+SHEETS_CONNECT_RETRY_MAX = float(os.getenv("SHEETS_CONNECT_RETRY_MAX", "60"))
 
 # --- Токен бота ---
 TOKEN = os.getenv("TELEGRAM_TOKEN")
 
 # --- Заголовки таблицы ---
-HEADERS = ["Имя", "Логин", "Бюджет", "Цель покупки", "Сроки", "Телефон"]
+HEADERS = ["Имя", "Логин", "Бюджет", "Цель покупки", "Сроки", "Телефон", "Telegram ID"]
 
-def ensure_sheet_headers() -> None:
+def ensure_sheet_headers(sheet) -> None:
     """Создаёт или обновляет первую строку с заголовками."""
     try:
         first_row = sheet.row_values(1)
         if first_row != HEADERS:
-            sheet.update("A1:F1", [HEADERS])
+            sheet.update(f"A1:{gspread.utils.rowcol_to_a1(1, len(HEADERS))}", [HEADERS])
+    except Exception:
+        # Не ломаем бота при временных ошибках сети, но оставляем след в логе
+        SUPPRESSED_ERRORS.inc("sheet_headers")
+        logging.warning("Не удалось проверить заголовки таблицы", exc_info=True)
+
+async def sheets_call(operation: str, fn, *args):
+    """Выполняет блокирующий вызов gspread в потоке и учитывает его в метриках."""
+    started = time.perf_counter()
+    try:
+        return await asyncio.to_thread(fn, *args)
     except Exception:
-        # Тихо пропускаем, чтобы не ломать бота при временных ошибках сети
-        pass
+        SHEETS_ERRORS.inc(operation)
+        raise
+    finally:
+        SHEETS_LATENCY.observe(time.perf_counter() - started, operation)
+
+_gspread_client = None
+_gspread_lock = threading.Lock()
+
+def _open_sheet(sheet_id: str | None = None):
+    # Один авторизованный клиент gspread (и его HTTP-сессия) на все таблицы процесса
+    global _gspread_client
+    with _gspread_lock:
+        if _gspread_client is None:
+            creds = ServiceAccountCredentials.from_json_keyfile_name(CREDS_FILE, SCOPES)
+            _gspread_client = gspread.authorize(creds)
+    return _gspread_client.open_by_key(sheet_id or SHEET_ID)
+
+class SheetsClient:
+    """Подключается к таблице в фоне: бот отвечает пользователям, не дожидаясь Google.
+
+    Пока таблица недоступна, лиды копятся в локальном хранилище.
+    get() отдаёт всю таблицу (gspread.Spreadsheet), листы выбирает SheetShards.
+    """
+
+    def __init__(self, opener=_open_sheet):
+        self.opener = opener
+        self._sheet = None
+        self._ready = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._on_ready: list = []
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def on_ready(self, callback) -> None:
+        self._on_ready.append(callback)
+
+    def start(self) -> None:
+        if self._task is None and not self.ready:
+            self._task = asyncio.create_task(self._connect())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def get(self):
+        await self._ready.wait()
+        return self._sheet
+
+    async def _connect(self) -> None:
+        delay = 1.0
+        while True:
+            try:
+                sheet = await sheets_call("open", self.opener)
+                break
+            except Exception:
+                logging.warning("Не удалось подключиться к таблице, повтор через %.0f с", delay, exc_info=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, SHEETS_CONNECT_RETRY_MAX)
+        while True:
+            try:
+                worksheets = await sheets_call("worksheets", sheet.worksheets)
+                break
+            except Exception:
+                logging.warning("Не удалось получить список листов, повтор через %.0f с", delay, exc_info=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, SHEETS_CONNECT_RETRY_MAX)
+        # Убедимся, что на первом листе есть строка с заголовками
+        await sheets_call("headers", ensure_sheet_headers, worksheets[0])
+        self._sheet = sheet
+        self._ready.set()
+        logging.info("Таблица подключена")
+        for callback in self._on_ready:
+            callback()
+
+# --- Локальное хранилище лидов (outbox) ---
+# Каждый лид сначала пишется локально, а в таблицу попадает фоновым воркером.
+# По умолчанию SQLite в data/, при LEAD_STORE_DSN=postgresql://... — Postgres через asyncpg.
+LEAD_STORE_DSN = os.getenv("LEAD_STORE_DSN", "")
+LEAD_STORE_PATH = os.getenv("LEAD_STORE_PATH", "data/leads.sqlite3")
+LEAD_STORE_POOL_SIZE = int(os.getenv("LEAD_STORE_POOL_SIZE", "5"))
+# Через сколько секунд бездействия незавершённая анкета сохраняется как есть
+PARTIAL_SAVE_TIMEOUT = int(os.getenv("PARTIAL_SAVE_TIMEOUT", "60"))
+# Идентификатор процесса для аренды записи в таблицу, когда реплик бота несколько
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# Поля анкеты в порядке колонок таблицы
+LEAD_FIELDS = ("name", "username", "budget", "goal", "timing", "phone")
+
+LEAD_STORE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS leads (
+        key TEXT PRIMARY KEY,
+        tenant TEXT NOT NULL DEFAULT 'default',
+        user_id BIGINT,
+        fields TEXT NOT NULL,
+        complete INTEGER NOT NULL DEFAULT 0,
+        created_at DOUBLE PRECISION NOT NULL,
+        updated_at DOUBLE PRECISION NOT NULL,
+        sent_at DOUBLE PRECISION,
+        attempts INTEGER NOT NULL DEFAULT 0
+    )""",
+    "CREATE INDEX IF NOT EXISTS leads_unsent ON leads (updated_at) WHERE sent_at IS NULL",
+    "CREATE INDEX IF NOT EXISTS leads_created ON leads (created_at)",
+    """CREATE TABLE IF NOT EXISTS lead_sheet_rows (
+        tenant TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        sheet TEXT NOT NULL,
+        row_number INTEGER NOT NULL,
+        PRIMARY KEY (tenant, kind, value)
+    )""",
+    """CREATE TABLE IF NOT EXISTS partial_snapshots (
+        tenant TEXT NOT NULL,
+        user_id BIGINT NOT NULL,
+        data TEXT NOT NULL,
+        deadline DOUBLE PRECISION NOT NULL,
+        PRIMARY KEY (tenant, user_id)
+    )""",
+    # Кто из реплик сейчас пишет лиды арендатора в таблицу
+    """CREATE TABLE IF NOT EXISTS writer_leases (
+        name TEXT PRIMARY KEY,
+        owner TEXT NOT NULL,
+        expires_at DOUBLE PRECISION NOT NULL
+    )""",
+)
+
+# Повторная отправка того же лида с теми же данными не ставит его в очередь заново
+SQL_PUT_LEAD = (
+    "INSERT INTO leads (key, tenant, user_id, fields, complete, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?) "
+    "ON CONFLICT (key) DO UPDATE SET fields = excluded.fields, complete = excluded.complete, "
+    "updated_at = excluded.updated_at, sent_at = NULL, attempts = 0 "
+    "WHERE leads.fields <> excluded.fields OR leads.complete <> excluded.complete"
+)
+# Отклонённые таблицей лиды уходят в конец очереди и не задерживают новые
+SQL_FETCH_UNSENT = (
+    "SELECT key, user_id, fields, updated_at, attempts FROM leads "
+    "WHERE sent_at IS NULL AND tenant = ? AND attempts < ? ORDER BY attempts, updated_at LIMIT ?"
+)
+# updated_at в условии: если лид успели обновить во время отправки, он уйдёт ещё раз
+SQL_MARK_SENT = "UPDATE leads SET sent_at = ? WHERE key = ? AND updated_at = ?"
+SQL_MARK_FAILED = "UPDATE leads SET attempts = attempts + 1 WHERE key = ?"
+SQL_COUNT_UNSENT = "SELECT count(*) FROM leads WHERE sent_at IS NULL"
+SQL_COUNT_ABANDONED = "SELECT count(*) FROM leads WHERE sent_at IS NULL AND attempts >= ?"
+SQL_RESEND_ABANDONED = (
+    "UPDATE leads SET attempts = 0 WHERE sent_at IS NULL AND attempts >= ? AND tenant = COALESCE(?, tenant)"
+)
+# tenant = NULL — лиды всех арендаторов
+SQL_ITER_LEADS = (
+    "SELECT key, user_id, fields, complete, created_at, updated_at, tenant FROM leads "
+    "WHERE created_at >= ? AND tenant = COALESCE(?, tenant) ORDER BY created_at"
+)
+SQL_SAVE_PENDING = (
+    "INSERT INTO partial_snapshots (tenant, user_id, data, deadline) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (tenant, user_id) DO UPDATE SET data = excluded.data, deadline = excluded.deadline"
+)
+SQL_DROP_PENDING = "DELETE FROM partial_snapshots WHERE tenant = ? AND user_id = ?"
+SQL_LIST_PENDING = "SELECT user_id, data, deadline FROM partial_snapshots WHERE tenant = ?"
+# Снимок забирает та реплика, что первой застала наступивший дедлайн; дедлайн сдвигается,
+# чтобы снимок не подхватили повторно, пока идёт сохранение
+SQL_CLAIM_PENDING = "UPDATE partial_snapshots SET deadline = ? WHERE tenant = ? AND user_id = ? AND deadline <= ?"
+SQL_PENDING_DEADLINE = "SELECT deadline FROM partial_snapshots WHERE tenant = ? AND user_id = ?"
+# Аренда продлевается владельцем или переходит к другой реплике после истечения
+SQL_ACQUIRE_LEASE = (
+    "INSERT INTO writer_leases (name, owner, expires_at) VALUES (?, ?, ?) "
+    "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+    "WHERE writer_leases.owner = excluded.owner OR writer_leases.expires_at < ?"
+)
+SQL_RELEASE_LEASE = "UPDATE writer_leases SET expires_at = 0 WHERE name = ? AND owner = ?"
+SQL_LOAD_INDEX = "SELECT kind, value, sheet, row_number FROM lead_sheet_rows WHERE tenant = ?"
+SQL_SAVE_INDEX = (
+    "INSERT INTO lead_sheet_rows (tenant, kind, value, sheet, row_number) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT (tenant, kind, value) DO UPDATE SET sheet = excluded.sheet, row_number = excluded.row_number"
+)
+SQL_CLEAR_INDEX = "DELETE FROM lead_sheet_rows WHERE tenant = ?"
+
+def _lead_stats_sql(groups: list[str], field, filled: tuple[str, ...]) -> str:
+    """Счётчики лидов по сегментам, считает сама база.
+
+    Строка результата: выражения groups, число лидов, завершённых, заполнивших каждое поле filled.
+    field(name) — выражение для поля анкеты из JSON: у SQLite и Postgres оно разное.
+    """
+    keys = ", ".join(groups)
+    counts = "".join(f", sum(CASE WHEN {field(name)} <> '' THEN 1 ELSE 0 END)" for name in filled)
+    return (f"SELECT {keys}, count(*), sum(complete){counts} FROM leads "
+            f"WHERE created_at >= ? AND tenant = COALESCE(?, tenant) GROUP BY {keys}")
+
+def _sqlite_json_field(name: str) -> str:
+    return f"coalesce(json_extract(fields, '$.{name}'), '')"
+
+def _pg_json_field(name: str) -> str:
+    return f"coalesce(fields::jsonb ->> '{name}', '')"
+
+def _dump_json(value: dict) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+def _affected_rows(status: str) -> int:
+    # asyncpg возвращает статус команды: "UPDATE 1", "INSERT 0 1"
+    return int(status.rsplit(" ", 1)[-1])
+
+def _to_pg_params(sql: str) -> str:
+    # ? -> $1, $2, ... для asyncpg
+    parts = sql.split("?")
+    return "".join(f"{p}${i}" for i, p in enumerate(parts[:-1], 1)) + parts[-1]
+
+class SqliteLeadStore:
+    """Хранилище лидов в локальном файле SQLite; запросы выполняются в потоке."""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _call(self, fn, *args):
+        with self._lock:
+            return fn(self._conn, *args)
+
+    async def _run(self, fn, *args):
+        return await asyncio.to_thread(self._call, fn, *args)
+
+    async def open(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for stmt in LEAD_STORE_SCHEMA:
+            self._conn.execute(stmt)
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._run(lambda conn: conn.close())
+            self._conn = None
+
+    async def put_lead(self, key: str, tenant: str, user_id: int | None, fields: dict, complete: bool) -> None:
+        now = time.time()
+        await self._run(lambda conn: conn.execute(
+            SQL_PUT_LEAD, (key, tenant, user_id, _dump_json(fields), int(complete), now, now)))
+
+    async def fetch_unsent(self, tenant: str, limit: int, max_attempts: int) -> list[tuple]:
+        return await self._run(lambda conn: conn.execute(SQL_FETCH_UNSENT, (tenant, max_attempts, limit)).fetchall())
+
+    async def mark_sent(self, items: list[tuple[str, float]]) -> None:
+        now = time.time()
+        await self._run(lambda conn: conn.executemany(SQL_MARK_SENT, [(now, k, u) for k, u in items]))
+
+    async def mark_failed(self, keys: list[str]) -> None:
+        await self._run(lambda conn: conn.executemany(SQL_MARK_FAILED, [(k,) for k in keys]))
+
+    async def count_unsent(self) -> int:
+        return (await self._run(lambda conn: conn.execute(SQL_COUNT_UNSENT).fetchone()))[0]
+
+    async def count_abandoned(self, max_attempts: int) -> int:
+        return (await self._run(lambda conn: conn.execute(SQL_COUNT_ABANDONED, (max_attempts,)).fetchone()))[0]
+
+    async def resend_abandoned(self, max_attempts: int, tenant: str | None = None) -> int:
+        return await self._run(lambda conn: conn.execute(SQL_RESEND_ABANDONED, (max_attempts, tenant)).rowcount)
+
+    async def iter_leads(self, chunk_size: int, since: float = 0.0, tenant: str | None = None):
+        """Отдаёт лиды пачками, не загружая всю таблицу в память."""
+        cursor = await self._run(lambda conn: conn.execute(SQL_ITER_LEADS, (since, tenant)))
+        while True:
+            rows = await self._run(lambda conn: cursor.fetchmany(chunk_size))
+            if not rows:
+                return
+            yield rows
+
+    async def lead_stats(self, since: float, tenant: str | None, group_by: tuple[str, ...],
+                         filled: tuple[str, ...]) -> list[tuple]:
+        """Строки: значения group_by, число лидов, завершённых, заполнивших каждое поле filled."""
+        # Поля сегмента — одним json_extract (JSON-массив): строка разбирается один раз, а не на каждое поле
+        paths = ", ".join(f"'$.{name}'" for name in group_by)
+        sql = _lead_stats_sql([f"json_extract(fields, {paths})"], _sqlite_json_field, filled)
+        rows = await self._run(lambda conn: conn.execute(sql, (since, tenant)).fetchall())
+        return [tuple("" if v is None else v for v in json.loads(key)) + tuple(rest) for key, *rest in rows]
+
+    async def save_pending(self, tenant: str, user_id: int, data: dict, deadline: float) -> None:
+        await self._run(lambda conn: conn.execute(SQL_SAVE_PENDING, (tenant, user_id, _dump_json(data), deadline)))
+
+    async def drop_pending(self, tenant: str, user_id: int) -> None:
+        await self._run(lambda conn: conn.execute(SQL_DROP_PENDING, (tenant, user_id)))
+
+    async def list_pending(self, tenant: str) -> list[tuple]:
+        return await self._run(lambda conn: conn.execute(SQL_LIST_PENDING, (tenant,)).fetchall())
+
+    async def claim_pending(self, tenant: str, user_id: int, now: float, until: float) -> bool:
+        return await self._run(lambda conn: conn.execute(SQL_CLAIM_PENDING, (until, tenant, user_id, now)).rowcount) > 0
+
+    async def pending_deadline(self, tenant: str, user_id: int) -> float | None:
+        row = await self._run(lambda conn: conn.execute(SQL_PENDING_DEADLINE, (tenant, user_id)).fetchone())
+        return row[0] if row else None
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        return await self._run(lambda conn: conn.execute(SQL_ACQUIRE_LEASE, (name, owner, now + ttl, now)).rowcount) > 0
+
+    async def release_lease(self, name: str, owner: str) -> None:
+        await self._run(lambda conn: conn.execute(SQL_RELEASE_LEASE, (name, owner)))
+
+    async def load_index(self, tenant: str) -> list[tuple]:
+        return await self._run(lambda conn: conn.execute(SQL_LOAD_INDEX, (tenant,)).fetchall())
+
+    async def save_index(self, tenant: str, records: list[tuple]) -> None:
+        await self._run(lambda conn: conn.executemany(SQL_SAVE_INDEX, [(tenant, *r) for r in records]))
+
+    async def replace_index(self, tenant: str, records: list[tuple]) -> None:
+        def replace(conn):
+            with conn:
+                conn.execute("BEGIN")
+                conn.execute(SQL_CLEAR_INDEX, (tenant,))
+                conn.executemany(SQL_SAVE_INDEX, [(tenant, *r) for r in records])
+        await self._run(replace)
+
+    async def execute(self, sql: str, *args) -> None:
+        await self._run(lambda conn: conn.execute(sql, args))
+
+    async def fetchone(self, sql: str, *args) -> tuple | None:
+        return await self._run(lambda conn: conn.execute(sql, args).fetchone())
+
+class PostgresLeadStore:
+    """То же хранилище поверх Postgres с пулом соединений asyncpg."""
+
+    def __init__(self, dsn: str, pool_size: int = LEAD_STORE_POOL_SIZE):
+        self.dsn = dsn
+        self.pool_size = pool_size
+        self._pool: asyncpg.Pool | None = None
+
+    async def open(self) -> None:
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.pool_size)
+        async with self._pool.acquire() as conn:
+            for stmt in LEAD_STORE_SCHEMA:
+                await conn.execute(stmt)
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def put_lead(self, key: str, tenant: str, user_id: int | None, fields: dict, complete: bool) -> None:
+        now = time.time()
+        await self._pool.execute(_to_pg_params(SQL_PUT_LEAD), key, tenant, user_id, _dump_json(fields), int(complete), now, now)
+
+    async def fetch_unsent(self, tenant: str, limit: int, max_attempts: int) -> list[tuple]:
+        rows = await self._pool.fetch(_to_pg_params(SQL_FETCH_UNSENT), tenant, max_attempts, limit)
+        return [tuple(r) for r in rows]
+
+    async def mark_sent(self, items: list[tuple[str, float]]) -> None:
+        now = time.time()
+        await self._pool.executemany(_to_pg_params(SQL_MARK_SENT), [(now, k, u) for k, u in items])
+
+    async def mark_failed(self, keys: list[str]) -> None:
+        await self._pool.executemany(_to_pg_params(SQL_MARK_FAILED), [(k,) for k in keys])
+
+    async def count_unsent(self) -> int:
+        return await self._pool.fetchval(SQL_COUNT_UNSENT)
+
+    async def count_abandoned(self, max_attempts: int) -> int:
+        return await self._pool.fetchval(_to_pg_params(SQL_COUNT_ABANDONED), max_attempts)
+
+    async def resend_abandoned(self, max_attempts: int, tenant: str | None = None) -> int:
+        return _affected_rows(await self._pool.execute(_to_pg_params(SQL_RESEND_ABANDONED), max_attempts, tenant))
+
+    async def iter_leads(self, chunk_size: int, since: float = 0.0, tenant: str | None = None):
+        """Отдаёт лиды пачками через серверный курсор."""
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(_to_pg_params(SQL_ITER_LEADS), since, tenant)
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        return
+                    yield [tuple(r) for r in rows]
+
+    async def lead_stats(self, since: float, tenant: str | None, group_by: tuple[str, ...],
+                         filled: tuple[str, ...]) -> list[tuple]:
+        sql = _lead_stats_sql([_pg_json_field(name) for name in group_by], _pg_json_field, filled)
+        return [tuple(r) for r in await self._pool.fetch(_to_pg_params(sql), since, tenant)]
+
+    async def save_pending(self, tenant: str, user_id: int, data: dict, deadline: float) -> None:
+        await self._pool.execute(_to_pg_params(SQL_SAVE_PENDING), tenant, user_id, _dump_json(data), deadline)
+
+    async def drop_pending(self, tenant: str, user_id: int) -> None:
+        await self._pool.execute(_to_pg_params(SQL_DROP_PENDING), tenant, user_id)
+
+    async def list_pending(self, tenant: str) -> list[tuple]:
+        return [tuple(r) for r in await self._pool.fetch(_to_pg_params(SQL_LIST_PENDING), tenant)]
+
+    async def claim_pending(self, tenant: str, user_id: int, now: float, until: float) -> bool:
+        status = await self._pool.execute(_to_pg_params(SQL_CLAIM_PENDING), until, tenant, user_id, now)
+        return _affected_rows(status) > 0
+
+    async def pending_deadline(self, tenant: str, user_id: int) -> float | None:
+        return await self._pool.fetchval(_to_pg_params(SQL_PENDING_DEADLINE), tenant, user_id)
+
+    async def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        status = await self._pool.execute(_to_pg_params(SQL_ACQUIRE_LEASE), name, owner, now + ttl, now)
+        return _affected_rows(status) > 0
+
+    async def release_lease(self, name: str, owner: str) -> None:
+        await self._pool.execute(_to_pg_params(SQL_RELEASE_LEASE), name, owner)
+
+    async def load_index(self, tenant: str) -> list[tuple]:
+        return [tuple(r) for r in await self._pool.fetch(_to_pg_params(SQL_LOAD_INDEX), tenant)]
+
+    async def save_index(self, tenant: str, records: list[tuple]) -> None:
+        await self._pool.executemany(_to_pg_params(SQL_SAVE_INDEX), [(tenant, *r) for r in records])
+
+    async def replace_index(self, tenant: str, records: list[tuple]) -> None:
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(_to_pg_params(SQL_CLEAR_INDEX), tenant)
+                await conn.executemany(_to_pg_params(SQL_SAVE_INDEX), [(tenant, *r) for r in records])
+
+    async def execute(self, sql: str, *args) -> None:
+        await self._pool.execute(_to_pg_params(sql), *args)
+
+    async def fetchone(self, sql: str, *args) -> tuple | None:
+        row = await self._pool.fetchrow(_to_pg_params(sql), *args)
+        return tuple(row) if row is not None else None
+
+def make_lead_store() -> SqliteLeadStore | PostgresLeadStore:
+    if LEAD_STORE_DSN.startswith(("postgres://", "postgresql://")):
+        return PostgresLeadStore(LEAD_STORE_DSN)
+    return SqliteLeadStore(LEAD_STORE_PATH)
+
+lead_store = make_lead_store()
+
+# --- Хранилище состояний FSM ---
+# Состояния анкеты лежат в той же базе, что и лиды: переживают перезапуск
+# и доступны нескольким процессам бота с одним токеном (при Postgres).
+# Состояние анкеты без изменений дольше FSM_STATE_TTL уже сохранено таймаутом анкеты или брошено.
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(PARTIAL_SAVE_TIMEOUT * 2)))
+# Остальные состояния (админ выбирает цель и ищет PDF) таймаута анкеты не имеют — живут дольше
+FSM_OTHER_STATE_TTL = float(os.getenv("FSM_OTHER_STATE_TTL", str(24 * 3600)))
+FSM_CLEANUP_INTERVAL = float(os.getenv("FSM_CLEANUP_INTERVAL", "60"))
+
+FSM_STORAGE_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at DOUBLE PRECISION NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS fsm_states_updated ON fsm_states (updated_at)",
+)
+SQL_FSM_SET_STATE = (
+    "INSERT INTO fsm_states (key, state, updated_at) VALUES (?, ?, ?) "
+    "ON CONFLICT (key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at"
+)
+SQL_FSM_SET_DATA = (
+    "INSERT INTO fsm_states (key, data, updated_at) VALUES (?, ?, ?) "
+    "ON CONFLICT (key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at"
+)
+SQL_FSM_SET_STATE_AND_DATA = (
+    "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at"
+)
+SQL_FSM_GET = "SELECT state, data FROM fsm_states WHERE key = ?"
+# Пустые записи (после state.clear()) и протухшие состояния удаляются фоновой очисткой;
+# у состояний анкеты (state LIKE 'survey:%') свой, короткий срок
+SQL_FSM_CLEANUP = (
+    "DELETE FROM fsm_states WHERE (state IS NULL AND data = '{}') "
+    "OR (updated_at < ? AND state LIKE ?) OR updated_at < ?"
+)
+
+class DbFsmStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх хранилища лидов (SQLite или Postgres).
+
+    С cache=True состояния читаются из памяти, а пишутся и в память, и в базу. Так можно,
+    только если базу не пишет никто, кроме этого процесса (SQLite): с Postgres обновления
+    одного пользователя могут попасть в разные реплики, и кэш бы устарел.
+    """
+
+    def __init__(self, store, ttl: float = FSM_STATE_TTL, other_ttl: float = FSM_OTHER_STATE_TTL, cache: bool = False):
+        self.store = store
+        self.ttl = ttl
+        self.other_ttl = other_ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cleanup_task: asyncio.Task | None = None
+        # ключ -> (состояние, данные в JSON, время записи); отсутствующая в базе запись — (None, "{}", ...)
+        self._cache: dict[str, tuple[str | None, str, float]] | None = {} if cache else None
+        # Счётчик записей: чтение, во время которого что-то писали, кэш не заполняет
+        self._writes = 0
+
+    async def open(self) -> None:
+        for stmt in FSM_STORAGE_SCHEMA:
+            await self.store.execute(stmt)
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self) -> None:
+        if self._cleanup_task is not None:
+            self._cleanup_task.cancel()
+            try:
+                await self._cleanup_task
+            except asyncio.CancelledError:
+                pass
+            self._cleanup_task = None
+
+    async def _cleanup_loop(self) -> None:
+        while True:
+            await asyncio.sleep(FSM_CLEANUP_INTERVAL)
+            await self.cleanup()
+
+    async def cleanup(self) -> None:
+        now = time.time()
+        if self._cache is not None:
+            # Те же правила, что в SQL_FSM_CLEANUP
+            for key, (state, data, updated_at) in list(self._cache.items()):
+                if ((state is None and data == "{}") or updated_at < now - self.other_ttl
+                        or (updated_at < now - self.ttl and state and state.startswith(SURVEY_STATE_PREFIX))):
+                    del self._cache[key]
+        try:
+            await self.store.execute(SQL_FSM_CLEANUP, now - self.ttl, SURVEY_STATE_PREFIX + "%", now - self.other_ttl)
+        except Exception:
+            logging.exception("Не удалось очистить устаревшие состояния FSM")
+
+    async def _load(self, key: str) -> tuple[str | None, str]:
+        if self._cache is not None and key in self._cache:
+            state, data, _ = self._cache[key]
+            return state, data
+        writes = self._writes
+        row = await self.store.fetchone(SQL_FSM_GET, key)
+        state, data = row if row else (None, "{}")
+        if self._cache is not None and writes == self._writes:
+            self._cache[key] = (state, data, time.time())
+        return state, data
+
+    async def _save(self, key: str, entry: tuple[str | None, str] | None, sql: str, *args) -> None:
+        """Пишет в базу; entry — новые (состояние, данные) для кэша, None — если их не знаем без чтения базы."""
+        now = time.time()
+        self._writes += 1
+        if self._cache is not None:
+            if entry is None:
+                self._cache.pop(key, None)
+            else:
+                self._cache[key] = (*entry, now)
+        try:
+            await self.store.execute(sql, key, *args, now)
+        except Exception:
+            # Не знаем, что теперь в базе: следующее чтение пойдёт туда
+            if self._cache is not None:
+                self._cache.pop(key, None)
+            raise
+
+    def _cached(self, key: str) -> tuple | None:
+        return self._cache.get(key) if self._cache is not None else None
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        built = self.key_builder.build(key)
+        cached = self._cached(built)
+        await self._save(built, (value, cached[1]) if cached else None, SQL_FSM_SET_STATE, value)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._load(self.key_builder.build(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        raw = _dump_json(data)
+        built = self.key_builder.build(key)
+        cached = self._cached(built)
+        await self._save(built, (cached[0], raw) if cached else None, SQL_FSM_SET_DATA, raw)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return json.loads((await self._load(self.key_builder.build(key)))[1])
+
+    async def set_state_and_data(self, key: StorageKey, state: StateType, data: dict) -> None:
+        """Состояние и данные одной записью — на шаге анкеты это один запрос вместо двух."""
+        value = state.state if isinstance(state, State) else state
+        raw = _dump_json(data)
+        await self._save(self.key_builder.build(key), (value, raw), SQL_FSM_SET_STATE_AND_DATA, value, raw)
+
+# Кэш состояний — только для SQLite: её файл пишет один процесс
+fsm_storage = DbFsmStorage(lead_store, cache=isinstance(lead_store, SqliteLeadStore))
+
+# --- Репликация лидов в таблицу ---
+SHEET_BATCH_SIZE = int(os.getenv("SHEET_BATCH_SIZE", "50"))
+SHEET_FLUSH_INTERVAL = float(os.getenv("SHEET_FLUSH_INTERVAL", "2"))
+SHEET_MAX_RETRIES = int(os.getenv("SHEET_MAX_RETRIES", "5"))
+SHEET_RETRY_BASE_DELAY = float(os.getenv("SHEET_RETRY_BASE_DELAY", "1"))
+# Как часто перепроверять недоставленные строки и сколько раз таблица может отклонить лид,
+# прежде чем от него откажутся (временные ошибки и лимиты не считаются);
+# вернуть такие лиды в очередь: python leads_cli.py resend
+SHEET_RETRY_INTERVAL = float(os.getenv("SHEET_RETRY_INTERVAL", "30"))
+SHEET_MAX_DELIVERY_ATTEMPTS = int(os.getenv("SHEET_MAX_DELIVERY_ATTEMPTS", "20"))
+# При нескольких репликах лиды арендатора пишет одна из них: у остальных свой индекс строк
+# и счётчики листов разошлись бы с таблицей. Аренда продлевается при каждой пачке и должна
+# быть заметно дольше SHEET_RETRY_INTERVAL; упавшую реплику сменит другая после истечения.
+SHEET_WRITER_LEASE = float(os.getenv("SHEET_WRITER_LEASE", "120"))
+
+def _is_retryable_sheet_error(exc: Exception) -> bool:
+    # 429 — квота, 5xx — временные ошибки Google; сетевые сбои тоже повторяем
+    if isinstance(exc, gspread.exceptions.APIError):
+        status = getattr(exc.response, "status_code", None)
+        return status == 429 or (status is not None and status >= 500)
+    return isinstance(exc, (ConnectionError, TimeoutError, OSError))
+
+def _is_sheet_access_error(exc: Exception) -> bool:
+    # Нет доступа к таблице или она удалена: строки тут ни при чём, попытки не засчитываются
+    if isinstance(exc, gspread.exceptions.APIError):
+        return getattr(exc.response, "status_code", None) in (401, 403, 404)
+    return False
+
+def _lead_row(fields: dict, user_id: int | None = None) -> list:
+    return [fields.get(name, "") for name in LEAD_FIELDS] + [user_id or ""]
+
+def _first_row_of_range(a1_range: str) -> int | None:
+    # "Sheet1!A5:G7" -> 5
+    match = re.search(r"![A-Z]+(\d+)", a1_range or "")
+    return int(match.group(1)) if match else None
+
+def _quote_title(title: str) -> str:
+    # Название листа в A1-нотации: 'Лиды 2026-10'!A1
+    return "'" + title.replace("'", "''") + "'"
+
+# --- Листы для лидов ---
+# Пусто — все лиды на первом листе; month — лист на месяц; goal / budget — лист на сегмент.
+SHEET_SHARD_BY = os.getenv("SHEET_SHARD_BY", "").strip().lower()
+SHEET_TITLE_PREFIX = os.getenv("SHEET_TITLE_PREFIX", "Лиды")
+# Заполненный лист продолжается следующим: «Лиды 2026-10 (2)» (0 — без ограничения)
+SHEET_SHARD_MAX_ROWS = int(os.getenv("SHEET_SHARD_MAX_ROWS", "50000"))
+SHEET_SHARD_FIELDS = {"goal": "goal", "budget": "budget"}
+_PART_SUFFIX = re.compile(r"^(.*) \((\d+)\)$")
+# Символы, которым не место в названии листа
+_TITLE_UNSAFE = re.compile(r"[\[\]:*?/\\]")
+
+class SheetShards:
+    """Выбирает лист для новых лидов, кэширует открытые листы и считает занятые строки.
+
+    Лист создаётся с заголовками при первой записи в него. Для дедупликации
+    просматриваются первый лист, листы с префиксом SHEET_TITLE_PREFIX и все их продолжения.
+    """
+
+    def __init__(self, shard_by: str = SHEET_SHARD_BY, prefix: str = SHEET_TITLE_PREFIX, max_rows: int = SHEET_SHARD_MAX_ROWS):
+        if shard_by and shard_by != "month" and shard_by not in SHEET_SHARD_FIELDS:
+            raise ValueError(f"Неизвестный SHEET_SHARD_BY: {shard_by}")
+        self.shard_by = shard_by
+        self.prefix = prefix
+        self.max_rows = max_rows
+        self._spreadsheet = None
+        self._default = ""
+        self._handles: dict[str, object] = {}
+        # Занятые строки листа вместе с заголовком
+        self._used: dict[str, int] = {}
+        # Номер последней части для каждого базового названия
+        self._parts: dict[str, int] = {}
+
+    def attach(self, spreadsheet, worksheets: list) -> None:
+        self._spreadsheet = spreadsheet
+        self._handles = {ws.title: ws for ws in worksheets}
+        self._default = worksheets[0].title
+        self._parts = {}
+        for title in self._handles:
+            self._note_part(title)
+
+    @staticmethod
+    def _split_part(title: str) -> tuple[str, int]:
+        """«Лист1 (3)» -> («Лист1», 3); лист без номера — первая часть."""
+        match = _PART_SUFFIX.match(title)
+        return (match.group(1), int(match.group(2))) if match else (title, 1)
+
+    def _note_part(self, title: str) -> None:
+        base, part = self._split_part(title)
+        self._parts[base] = max(self._parts.get(base, 1), part)
+
+    def lead_titles(self) -> list[str]:
+        titles = []
+        for title in self._handles:
+            base, _ = self._split_part(title)
+            if base == self._default or base.startswith(self.prefix):
+                titles.append(title)
+        return titles
+
+    def set_used(self, title: str, rows: int) -> None:
+        self._used[title] = max(1, rows)
+
+    def record(self, title: str, last_row: int) -> None:
+        self._used[title] = max(self._used.get(title, 1), last_row)
+
+    def base_for(self, fields: dict) -> str:
+        if self.shard_by == "month":
+            return f"{self.prefix} {time.strftime('%Y-%m')}"
+        if self.shard_by:
+            value = fields.get(SHEET_SHARD_FIELDS[self.shard_by]) or "без ответа"
+            return f"{self.prefix} — {_TITLE_UNSAFE.sub(' ', value)}"[:100]
+        return self._default
+
+    def _title(self, base: str, part: int) -> str:
+        return base if part == 1 else f"{base} ({part})"
+
+    def split(self, base: str, count: int) -> list[tuple[str, int]]:
+        """Раскладывает count новых строк по частям листа с учётом SHEET_SHARD_MAX_ROWS."""
+        part = self._parts.get(base, 1)
+        chunks = []
+        while count > 0:
+            title = self._title(base, part)
+            free = count if self.max_rows <= 0 else self.max_rows - self._used.get(title, 1)
+            if free <= 0:
+                part += 1
+                continue
+            take = min(free, count)
+            chunks.append((title, take))
+            count -= take
+            part += 1
+        return chunks
+
+    async def worksheet(self, title: str):
+        ws = self._handles.get(title)
+        if ws is None:
+            ws = await sheets_call("add_worksheet", self._spreadsheet.add_worksheet, title, 1000, len(HEADERS))
+            await sheets_call("headers", ensure_sheet_headers, ws)
+            self._handles[title] = ws
+            self._used[title] = 1
+            self._note_part(title)
+            logging.info("Создан лист для лидов: %s", title)
+        return ws
+
+
+# --- Индекс лидов для дедупликации ---
+class LeadIndex:
+    """Лист и номер строки по Telegram ID и по нормализованному телефону.
+
+    Держится в памяти и дублируется в локальном хранилище; при подключении к
+    таблице пересобирается одним запросом values_batch_get по всем листам с лидами.
+    """
+
+    def __init__(self, store, tenant: str):
+        self.store = store
+        self.tenant = tenant
+        self._by_user: dict[int, tuple[str, int]] = {}
+        self._by_phone: dict[str, tuple[str, int]] = {}
+        self.synced = False
+
+    def __len__(self) -> int:
+        return len(self._by_user) + len(self._by_phone)
+
+    async def load(self) -> None:
+        records = await self.store.load_index(self.tenant)
+        self._by_user.clear()
+        self._by_phone.clear()
+        for kind, value, sheet, row in records:
+            self._put(kind, value, sheet, row)
+
+    def _put(self, kind: str, value: str, sheet: str, row: int) -> None:
+        if kind == "user":
+            self._by_user[int(value)] = (sheet, row)
+        elif kind == "phone":
+            self._by_phone[value] = (sheet, row)
+
+    def find(self, user_id: int | None, phone: str | None) -> tuple[str, int] | None:
+        row = self._by_user.get(user_id) if user_id else None
+        if row is None and phone:
+            row = self._by_phone.get(phone)
+        return row
+
+    async def remember(self, entries: list[tuple[int | None, str | None, str, int]]) -> None:
+        records = []
+        for user_id, phone, sheet, row in entries:
+            if user_id:
+                records.append(("user", str(user_id), sheet, row))
+            if phone:
+                records.append(("phone", phone, sheet, row))
+        for record in records:
+            self._put(*record)
+        if records:
+            await self.store.save_index(self.tenant, records)
+
+    async def rebuild(self, sheets_values: dict[str, list[list[str]]]) -> None:
+        """Пересобирает индекс по содержимому листов (первая строка — заголовки)."""
+        user_col = len(LEAD_FIELDS)
+        phone_col = LEAD_FIELDS.index("phone")
+        records = []
+        for sheet, values in sheets_values.items():
+            for row_number, row in enumerate(values[1:], start=2):
+                user_id = row[user_col].strip() if len(row) > user_col else ""
+                phone = normalize_phone(row[phone_col]) if len(row) > phone_col else None
+                if user_id.isdigit():
+                    records.append(("user", user_id, sheet, row_number))
+                if phone:
+                    records.append(("phone", phone, sheet, row_number))
+        self._by_user.clear()
+        self._by_phone.clear()
+        for record in records:
+            self._put(*record)
+        await self.store.replace_index(self.tenant, records)
+        self.synced = True
+
+
+class SheetWriter:
+    """Пачками переносит недоставленные лиды из локального хранилища в таблицу.
+
+    Доставка at-least-once: лид помечается отправленным только после успешной записи.
+    Таблицу арендатора пишет только реплика, которая держит её аренду в хранилище.
+    У каждого арендатора свой воркер: бэкофф или сбой одной таблицы не задерживает остальные.
+    """
+
+    def __init__(self, store, batch_size: int = SHEET_BATCH_SIZE, flush_interval: float = SHEET_FLUSH_INTERVAL,
+                 max_retries: int = SHEET_MAX_RETRIES, retry_base_delay: float = SHEET_RETRY_BASE_DELAY):
+        self.store = store
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self._wakeups: dict[str, asyncio.Event] = {}
+        self._stopped = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        # Арендаторы, чью таблицу сейчас пишет этот процесс
+        self._leased: set[str] = set()
+
+    async def submit(self, key: str, tenant: str, user_id: int | None, fields: dict, complete: bool) -> None:
+        """Сохраняет лид локально; в таблицу арендатора он уйдёт в фоне."""
+        await self.store.put_lead(key, tenant, user_id, fields, complete)
+        self.wake(tenant)
+
+    def _wakeup(self, tenant: str) -> asyncio.Event:
+        return self._wakeups.setdefault(tenant, asyncio.Event())
+
+    def start(self) -> None:
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run(tenant)) for tenant in tenants.all()]
+
+    async def stop(self) -> None:
+        """Пытается дописать накопившееся и останавливает воркер; недоставленное остаётся в хранилище."""
+        if not self._tasks:
+            return
+        self._stopped.set()
+        for event in self._wakeups.values():
+            event.set()
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+        # Отпускаем аренду сразу, чтобы другая реплика не ждала её истечения
+        for name in list(self._leased):
+            try:
+                await self.store.release_lease(f"sheets:{name}", INSTANCE_ID)
+            except Exception:
+                SUPPRESSED_ERRORS.inc("writer_lease_release")
+        self._leased.clear()
+
+    async def _wait(self, event: asyncio.Event, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self, tenant) -> None:
+        wakeup = self._wakeup(tenant.name)
+        while not self._stopped.is_set():
+            # Ждём новых лидов; по таймауту повторяем то, что не доставилось раньше
+            await self._wait(wakeup, SHEET_RETRY_INTERVAL)
+            # Даём строкам накопиться в пачку
+            await self._wait(self._stopped, self.flush_interval)
+            wakeup.clear()
+            await self._drain(tenant)
+        await self._drain(tenant)
+
+    def wake(self, tenant: str) -> None:
+        self._wakeup(tenant).set()
+
+    async def _sync_index(self, tenant) -> None:
+        spreadsheet = await tenant.sheets.get()
+        try:
+            tenant.shards.attach(spreadsheet, await sheets_call("worksheets", spreadsheet.worksheets))
+            titles = tenant.shards.lead_titles()
+            response = await sheets_call("values_batch_get", spreadsheet.values_batch_get, [_quote_title(t) for t in titles])
+        except Exception:
+            logging.warning("Не удалось прочитать таблицу для индекса, используем локальную копию", exc_info=True)
+            return
+        sheets_values = {title: value_range.get("values", [])
+                         for title, value_range in zip(titles, response.get("valueRanges", []))}
+        for title, values in sheets_values.items():
+            tenant.shards.set_used(title, len(values))
+        await tenant.index.rebuild(sheets_values)
+        rows = sum(max(0, len(values) - 1) for values in sheets_values.values())
+        logging.info("[%s] Индекс лидов пересобран: %d строк(и) на %d лист(ах)", tenant.name, rows, len(sheets_values))
+
+    def _plan(self, tenant, batch: list[tuple]) -> tuple[dict[tuple, list], list[list], list[tuple], list[tuple]]:
+        """Делит пачку на обновления известных строк и новые строки.
+
+        Лиды одного пользователя (или с одним телефоном) внутри пачки схлопываются в одну строку.
+        Обновление пишется туда, где строка уже есть, даже если сейчас лид попал бы на другой лист.
+        """
+        updates: dict[tuple[str, int], list] = {}
+        appends: list[list] = []
+        # (user_id, телефон, базовое название листа) для каждой новой строки
+        owners: list[tuple[int | None, str | None, str]] = []
+        # Известные строки: телефон или ID могли появиться только сейчас
+        known: list[tuple[int | None, str | None, str, int]] = []
+        slot_by_user: dict[int, int] = {}
+        slot_by_phone: dict[str, int] = {}
+        for _, user_id, raw, *_ in batch:
+            fields = json.loads(raw)
+            values = _lead_row(fields, user_id)
+            phone = fields.get("phone") or None
+            found = tenant.index.find(user_id, phone)
+            if found is not None:
+                updates[found] = values
+                known.append((user_id, phone, *found))
+                continue
+            slot = slot_by_user.get(user_id) if user_id else None
+            if slot is None and phone:
+                slot = slot_by_phone.get(phone)
+            if slot is None:
+                slot = len(appends)
+                appends.append(values)
+                owners.append((user_id, phone, tenant.shards.base_for(fields)))
+            else:
+                appends[slot] = values
+                owners[slot] = (owners[slot][0] or user_id, phone or owners[slot][1], owners[slot][2])
+            if user_id:
+                slot_by_user[user_id] = slot
+            if phone:
+                slot_by_phone[phone] = slot
+        return updates, appends, owners, known
+
+    async def _drain(self, tenant) -> None:
+        try:
+            await self._drain_tenant(tenant)
+        except Exception:
+            logging.exception("[%s] Ошибка записи лидов в таблицу", tenant.name)
+
+    async def _hold_lease(self, tenant) -> bool:
+        held = await self.store.acquire_lease(f"sheets:{tenant.name}", INSTANCE_ID, SHEET_WRITER_LEASE)
+        if not held:
+            self._leased.discard(tenant.name)
+        elif tenant.name not in self._leased:
+            # Таблицу до нас могла писать другая реплика: перечитываем индекс и листы
+            self._leased.add(tenant.name)
+            await tenant.index.load()
+            tenant.index.synced = False
+        return held
+
+    async def _drain_tenant(self, tenant) -> None:
+        # До подключения к таблице лиды просто ждут в хранилище
+        if not tenant.sheets.ready:
+            return
+        if not await self._hold_lease(tenant):
+            return
+        if not tenant.index.synced:
+            await self._sync_index(tenant)
+        rejected: set[str] = set()
+        while True:
+            if not await self._hold_lease(tenant):
+                return
+            batch = await self.store.fetch_unsent(tenant.name, self.batch_size, SHEET_MAX_DELIVERY_ATTEMPTS)
+            # Отклонённые в этом проходе лиды стоят в конце очереди: дальше идут только они
+            batch = [lead for lead in batch if lead[0] not in rejected]
+            if not batch:
+                return
+            error = await self._deliver(tenant, batch)
+            if error is not None:
+                if _is_retryable_sheet_error(error) or _is_sheet_access_error(error):
+                    return
+                # Таблица отклонила пачку: доставляем лиды по одному, чтобы найти виноватые
+                for lead in batch:
+                    if len(batch) > 1:
+                        error = await self._deliver(tenant, [lead])
+                    if error is None:
+                        continue
+                    if _is_retryable_sheet_error(error) or _is_sheet_access_error(error):
+                        return
+                    rejected.add(lead[0])
+                    await self._reject(tenant, lead)
+            if len(batch) < self.batch_size:
+                return
+
+    async def _deliver(self, tenant, batch: list[tuple]) -> Exception | None:
+        """Пишет пачку лидов в таблицу; возвращает ошибку, если записать не удалось."""
+        updates, appends, owners, known = self._plan(tenant, batch)
+        error = await self._flush(tenant, updates, appends, owners)
+        if error is None:
+            await tenant.index.remember(known)
+            await self.store.mark_sent([(key, updated_at) for key, _, _, updated_at, _ in batch])
+        return error
+
+    async def _reject(self, tenant, lead: tuple) -> None:
+        key, attempts = lead[0], lead[4] + 1
+        await self.store.mark_failed([key])
+        if attempts >= SHEET_MAX_DELIVERY_ATTEMPTS:
+            SHEETS_ROWS.inc("abandoned")
+            logging.error("[%s] Таблица %d раз отклонила лид %s, больше он не отправляется; "
+                          "вернуть в очередь: python leads_cli.py resend", tenant.name, attempts, key)
+
+    async def _write(self, tenant, updates: dict[tuple, list], appends: list[list], owners: list[tuple],
+                     written: set[int]) -> None:
+        """Пишет пачку; при повторе после ошибки пропускает то, что уже записано.
+
+        Выполненные обновления удаляются из updates, номера добавленных строк копятся в written.
+        """
+        spreadsheet = await tenant.sheets.get()
+        if updates:
+            # Обновления на всех листах — одним запросом
+            last_col = gspread.utils.rowcol_to_a1(1, len(HEADERS)).rstrip("1")
+            data = [{"range": f"{_quote_title(sheet)}!A{row}:{last_col}{row}", "values": [values]}
+                    for (sheet, row), values in updates.items()]
+            await sheets_call("batch_update", spreadsheet.values_batch_update, {"valueInputOption": "RAW", "data": data})
+            updates.clear()
+        # Новые строки — по одному append_rows на лист
+        by_base: dict[str, list[int]] = {}
+        for i, owner in enumerate(owners):
+            if i not in written:
+                by_base.setdefault(owner[2], []).append(i)
+        for base, slots in by_base.items():
+            for title, count in tenant.shards.split(base, len(slots)):
+                chunk, slots = slots[:count], slots[count:]
+                worksheet = await tenant.shards.worksheet(title)
+                response = await sheets_call("append_rows", worksheet.append_rows, [appends[i] for i in chunk])
+                written.update(chunk)
+                first_row = _first_row_of_range(((response or {}).get("updates") or {}).get("updatedRange", ""))
+                if first_row is None:
+                    logging.warning("Таблица не вернула диапазон добавленных строк, индекс не обновлён")
+                    continue
+                tenant.shards.record(title, first_row + len(chunk) - 1)
+                await tenant.index.remember([(owners[i][0], owners[i][1], title, first_row + n) for n, i in enumerate(chunk)])
+
+    async def _flush(self, tenant, updates: dict[tuple, list], appends: list[list],
+                     owners: list[tuple]) -> Exception | None:
+        count = len(updates) + len(appends)
+        updated = len(updates)
+        updates = dict(updates)
+        # Строки, уже добавленные в таблицу: повтор не должен дописать их второй раз
+        written: set[int] = set()
+        # При остановке не ждём бэкоффов (и прерываем начатый): строки и так останутся в хранилище
+        retries = 0 if self._stopped.is_set() else self.max_retries
+        for attempt in range(retries + 1):
+            try:
+                await self._write(tenant, updates, appends, owners, written)
+                SHEETS_ROWS.inc("written", amount=len(appends))
+                SHEETS_ROWS.inc("updated", amount=updated)
+                return None
+            except Exception as exc:
+                if attempt >= retries or self._stopped.is_set() or not _is_retryable_sheet_error(exc):
+                    SHEETS_ROWS.inc("failed", amount=count)
+                    logging.exception("Не удалось записать %d строк(и) в таблицу, остаются в очереди: %s",
+                                      count, json.dumps(appends + list(updates.values()), ensure_ascii=False))
+                    return exc
+                delay = self.retry_base_delay * (2 ** attempt)
+                logging.warning("Ошибка записи в таблицу (%s), повтор через %.1f с", exc, delay)
+                await self._wait(self._stopped, delay)
+
+sheet_writer = SheetWriter(lead_store)
+metrics.register(Gauge("leads_outbox_unsent", "Лиды, ещё не записанные в таблицу", lambda: lead_store.count_unsent()))
+metrics.register(Gauge("leads_outbox_abandoned", "Лиды, от доставки которых отказались",
+                       lambda: lead_store.count_abandoned(SHEET_MAX_DELIVERY_ATTEMPTS)))
 
 # (tgs import functionality removed)
 
 # --- Машина состояний ---
  
 
-# --- Простая анкета Юлии ---
-class Survey(StatesGroup):
-    name = State()
-    budget = State()
-    goal = State()
-    timing = State()
-    phone = State()
-
 # --- Настройки PDF админом ---
 class PdfSetup(StatesGroup):
     choose_goal = State()
@@ -67,28 +1298,30 @@ class PdfSetup(StatesGroup):
  
 
 # Клавиатуры анкеты (inline)
-def make_budget_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="10-20 млн руб", callback_data="budget:10-20 млн руб")],
-        [InlineKeyboardButton(text="20-50 млн руб", callback_data="budget:20-50 млн руб")],
-        [InlineKeyboardButton(text="50-80 млн руб", callback_data="budget:50-80 млн руб")],
-        [InlineKeyboardButton(text="Более 100 млн руб", callback_data="budget:Более 100 млн руб")],
-    ])
+# В callback_data — номер шага анкеты и номер варианта, а не сама подпись:
+# так укладываемся в лимит Telegram 64 байта и не зависим от длины текста кнопок.
+class SurveyChoice(CallbackData, prefix="sv"):
+    q: int
+    i: int
 
-def make_goal_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Перепродажа", callback_data="goal:Перепродажа")],
-        [InlineKeyboardButton(text="Для сдачи/пассивного дохода", callback_data="goal:Для сдачи/пассивного дохода")],
-        [InlineKeyboardButton(text="И то и другое", callback_data="goal:И то и другое")],
-        [InlineKeyboardButton(text="Хотим свой дом у моря ❤️", callback_data="goal:Хотим свой дом у моря ❤️")],
-    ])
+# Цель PDF передаётся слагом: он короткий и не зависит от порядка вариантов в анкете
+class PdfGoalChoice(CallbackData, prefix="pdfgoal"):
+    slug: str
 
-def make_timing_kb() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="В течение месяца", callback_data="timing:В течение месяца")],
-        [InlineKeyboardButton(text="2-3 месяца", callback_data="timing:2-3 месяца")],
-        [InlineKeyboardButton(text="4 и более месяца", callback_data="timing:4 и более месяца")],
-    ])
+class SurveyOptions:
+    """Варианты ответа на шаг анкеты; клавиатура собирается один раз при загрузке анкеты."""
+
+    def __init__(self, code: int, labels: list[str]):
+        self.code = code
+        self.labels = tuple(labels)
+        self.markup = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=label, callback_data=SurveyChoice(q=code, i=i).pack())]
+            for i, label in enumerate(self.labels)
+        ])
+
+    def label(self, index: int) -> str | None:
+        """Подпись варианта по номеру из callback_data; None для устаревших или чужих кнопок."""
+        return self.labels[index] if 0 <= index < len(self.labels) else None
 
  
 
@@ -134,13 +1367,111 @@ def normalize_phone(raw: str) -> str | None:
     # Otherwise, reject
     return None
 
+# --- Анкета из конфига ---
+# Шаги, тексты, варианты ответов и проверки описаны в survey.json; воронок может быть
+# несколько (A/B), пользователь попадает в одну из них по весам и остаётся в ней.
+SURVEY_CONFIG_PATH = Path(os.getenv("SURVEY_CONFIG_PATH", "survey.json"))
+# Состояние FSM на шаге анкеты: "survey:<воронка>:<номер шага>"
+SURVEY_STATE_PREFIX = "survey:"
+
+def _validate_text(raw: str) -> str | None:
+    return raw.strip() or None
+
+# Проверки текстовых ответов: нормализованное значение или None, если ответ не подходит
+SURVEY_VALIDATORS = {
+    "text": _validate_text,
+    "phone": normalize_phone,
+}
+
+class _PromptValues(dict):
+    def __missing__(self, key: str) -> str:
+        return ""
+
+class SurveyStep:
+    def __init__(self, funnel: str, index: int, spec: dict):
+        self.index = index
+        self.id = spec["id"]
+        self.field = spec.get("field", self.id)
+        self.state = f"{SURVEY_STATE_PREFIX}{funnel}:{index}"
+        self.prompt = spec["prompt"]
+        self.options = SurveyOptions(index, spec["options"]) if spec.get("options") else None
+        validator = spec.get("validator", "text")
+        if validator not in SURVEY_VALIDATORS:
+            raise ValueError(f"Неизвестная проверка '{validator}' на шаге '{self.id}'")
+        self.validate = SURVEY_VALIDATORS[validator]
+        self.error = spec.get("error", "Пожалуйста, ответьте текстом.")
+
+    @property
+    def markup(self) -> InlineKeyboardMarkup | None:
+        return self.options.markup if self.options else None
+
+    def render(self, data: dict) -> str:
+        # Подстановки вида {name} из уже собранных ответов; ответы экранируются для HTML
+        return self.prompt.format_map(_PromptValues({k: html.escape(str(v)) for k, v in data.items()}))
+
+class SurveyFunnel:
+    def __init__(self, name: str, spec: dict):
+        self.name = name
+        self.weight = int(spec.get("weight", 1))
+        self.intro = spec.get("intro", INTRO_TEXT)
+        self.done = spec["done"]
+        self.steps = [SurveyStep(name, i, step) for i, step in enumerate(spec["steps"])]
+        if not self.steps:
+            raise ValueError(f"В воронке '{name}' нет шагов")
+
+    def next_step(self, step: SurveyStep) -> SurveyStep | None:
+        index = step.index + 1
+        return self.steps[index] if index < len(self.steps) else None
+
+class SurveyEngine:
+    """Воронки анкеты из конфига и поиск шага по состоянию FSM за O(1)."""
+
+    def __init__(self, path: Path = SURVEY_CONFIG_PATH):
+        self.path = path
+        self.funnels: dict[str, SurveyFunnel] = {}
+        self._by_state: dict[str, tuple[SurveyFunnel, SurveyStep]] = {}
+        self._order: list[SurveyFunnel] = []
+        self._bounds: list[int] = []
+
+    def load(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        funnels = {name: SurveyFunnel(name, spec) for name, spec in config["funnels"].items()}
+        order = [funnel for funnel in funnels.values() if funnel.weight > 0]
+        if not order:
+            raise ValueError(f"В {self.path} нет ни одной воронки с положительным весом")
+        self.funnels = funnels
+        self._by_state = {step.state: (funnel, step) for funnel in funnels.values() for step in funnel.steps}
+        self._order = order
+        self._bounds = list(itertools.accumulate(funnel.weight for funnel in order))
+
+    def pick(self, user_id: int | None) -> SurveyFunnel:
+        # Детерминированно по user_id: при повторном /start пользователь видит ту же воронку
+        bucket = zlib.crc32(str(user_id or 0).encode()) % self._bounds[-1]
+        return self._order[bisect.bisect_right(self._bounds, bucket)]
+
+    def step_for(self, raw_state: str | None) -> tuple[SurveyFunnel, SurveyStep] | None:
+        return self._by_state.get(raw_state) if raw_state else None
+
+    def options(self, field: str) -> list[str]:
+        """Все варианты ответа для поля по всем воронкам, без повторов."""
+        labels: dict[str, None] = {}
+        for funnel in self.funnels.values():
+            for step in funnel.steps:
+                if step.field == field and step.options:
+                    labels.update(dict.fromkeys(step.options.labels))
+        return list(labels)
+
+def in_survey(event, raw_state: str | None = None) -> bool:
+    return bool(raw_state) and raw_state.startswith(SURVEY_STATE_PREFIX)
+
  
 
 logging.basicConfig(level=logging.INFO)
 
 # --- Минимальная админ-подсистема (только для /pdf) ---
-def _parse_admin_ids_from_env() -> set[int]:
-    raw = os.getenv("ADMIN_IDS", "").replace(";", ",")
+def _parse_admin_ids(raw: str) -> set[int]:
+    raw = raw.replace(";", ",")
     ids: set[int] = set()
     for part in raw.split(','):
         p = part.strip()
@@ -151,15 +1482,107 @@ def _parse_admin_ids_from_env() -> set[int]:
                 continue
     return ids
 
-ADMIN_IDS = _parse_admin_ids_from_env()
+ADMIN_IDS = _parse_admin_ids(os.getenv("ADMIN_IDS", ""))
+
+# --- Кэш file_id для картинки и презентаций ---
+MEDIA_CACHE_PATH = Path(os.getenv("MEDIA_CACHE_PATH", "data/media_cache.json"))
+
+def _write_json_atomic(path: Path, value) -> None:
+    # Пишем во временный файл и переименовываем, чтобы не оставить полузаписанный JSON.
+    # Имя временного файла уникальное: два одновременных сохранения не пишут в один файл.
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False, indent=2)
+            f.flush()
+            # Данные на диске до переименования: после сбоя питания не останется пустого файла
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+class MediaCache:
+    """Запоминает file_id, который Telegram вернул после первой загрузки файла.
+
+    Запись привязана к пути и mtime/размеру: заменённый файл будет загружен заново.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._entries: dict[str, dict] = {}
 
-def is_admin(user_id: int | None) -> bool:
-    return bool(user_id and user_id in ADMIN_IDS)
+    def load(self) -> None:
+        try:
+            if self.path.exists():
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    self._entries = data
+        except Exception:
+            logging.exception("Не удалось прочитать кэш медиа %s", self.path)
+
+    def _save(self) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            _write_json_atomic(self.path, self._entries)
+        except Exception:
+            logging.exception("Не удалось сохранить кэш медиа %s", self.path)
+
+    @staticmethod
+    def _signature(file_path: Path) -> str:
+        st = file_path.stat()
+        return f"{st.st_mtime_ns}:{st.st_size}"
+
+    def get(self, file_path: Path) -> str | None:
+        entry = self._entries.get(str(file_path))
+        if not entry:
+            return None
+        try:
+            if entry.get("sig") == self._signature(file_path):
+                return entry.get("file_id")
+        except OSError:
+            pass
+        return None
+
+    def put(self, file_path: Path, file_id: str) -> None:
+        self._entries[str(file_path)] = {"sig": self._signature(file_path), "file_id": file_id}
+        self._save()
+
+    def invalidate(self, file_path: Path) -> None:
+        if self._entries.pop(str(file_path), None) is not None:
+            self._save()
+
+def _sent_file_id(sent: Message) -> str | None:
+    if sent.photo:
+        return sent.photo[-1].file_id
+    if sent.document:
+        return sent.document.file_id
+    return None
+
+async def send_cached_media(media_cache: MediaCache, file_path: Path, send) -> Message:
+    """Отправляет файл по сохранённому file_id, а при его отсутствии — загружает и запоминает.
+
+    file_id действует только для бота, который загрузил файл, поэтому кэш у каждого арендатора свой.
+    """
+    file_id = media_cache.get(file_path)
+    if file_id:
+        try:
+            return await send(file_id)
+        except TelegramBadRequest:
+            # file_id мог устареть — загрузим файл заново
+            media_cache.invalidate(file_path)
+    sent = await send(FSInputFile(str(file_path)))
+    file_id = _sent_file_id(sent)
+    if file_id:
+        media_cache.put(file_path, file_id)
+    return sent
 
 # --- Конфиг PDF ---
-PDF_CONFIG_PATH = Path("pdf_config.json")
+PDF_CONFIG_PATH = Path(os.getenv("PDF_CONFIG_PATH", "pdf_config.json"))
 
-# Список целей для admin UI и файловые слаги
+# Файловые слаги целей из стандартной анкеты; для остальных целей слаг строится по названию
 PDF_GOAL_SLUGS: dict[str, str] = {
     "Перепродажа": "flip",
     "Для сдачи/пассивного дохода": "rent",
@@ -168,139 +1591,848 @@ PDF_GOAL_SLUGS: dict[str, str] = {
     "default": "default",
 }
 
-def load_pdf_mapping() -> dict:
+DEFAULT_PDF_PATH = "data/презентация.pdf"
+# Как часто (в секундах) проверять, не изменили ли pdf_config.json вручную
+PDF_CONFIG_CHECK_INTERVAL = float(os.getenv("PDF_CONFIG_CHECK_INTERVAL", "10"))
+
+def _read_pdf_mapping_file(path: Path) -> dict:
     try:
-        if PDF_CONFIG_PATH.exists():
-            with open(PDF_CONFIG_PATH, "r", encoding="utf-8") as f:
+        if path.exists():
+            with open(path, "r", encoding="utf-8") as f:
                 data = json.load(f)
                 if isinstance(data, dict):
                     return data
     except Exception:
-        pass
+        logging.exception("Не удалось прочитать %s", path)
     return {}
 
-def save_pdf_mapping(mapping: dict) -> None:
+class PdfRoutes:
+    """Таблица цель -> PDF в памяти; файлы проверяются один раз при загрузке конфига."""
+
+    def __init__(self, config_path: Path = PDF_CONFIG_PATH, default_path: Path = Path(DEFAULT_PDF_PATH)):
+        self.config_path = config_path
+        self.default_path = default_path
+        self._mapping: dict = {}
+        self._table: dict[str, Path] = {}
+        self._default: Path | None = None
+        # -1 — ещё не загружали: первый же resolve прочитает конфиг
+        self._mtime_ns: int | None = -1
+        self._checked_at = float("-inf")
+
+    def _config_mtime(self) -> int | None:
+        try:
+            return self.config_path.stat().st_mtime_ns
+        except OSError:
+            return None
+
+    def _rebuild(self, mapping: dict) -> None:
+        table: dict[str, Path] = {}
+        for goal, path_str in mapping.items():
+            path = Path(str(path_str))
+            if path.exists():
+                table[goal] = path
+            else:
+                logging.warning("PDF для цели '%s' не найден: %s", goal, path)
+        default = table.get("default")
+        if default is None and self.default_path.exists():
+            default = self.default_path
+        self._mapping = mapping
+        self._table = table
+        self._default = default
+
+    def reload(self) -> None:
+        self._mtime_ns = self._config_mtime()
+        self._checked_at = time.monotonic()
+        self._rebuild(_read_pdf_mapping_file(self.config_path))
+
+    def _maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < PDF_CONFIG_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        if self._config_mtime() != self._mtime_ns:
+            self.reload()
+
+    def mapping(self) -> dict:
+        self._maybe_reload()
+        return dict(self._mapping)
+
+    def save(self, mapping: dict) -> None:
+        self.config_path.parent.mkdir(parents=True, exist_ok=True)
+        _write_json_atomic(self.config_path, mapping)
+        self._mtime_ns = self._config_mtime()
+        self._checked_at = time.monotonic()
+        self._rebuild(dict(mapping))
+
+    def resolve(self, goal: str | None) -> Path | None:
+        """Путь к PDF для цели; если своего файла нет — дефолтная презентация."""
+        self._maybe_reload()
+        return self._table.get(goal, self._default) if goal else self._default
+
+def save_pdf_mapping(routes: PdfRoutes, mapping: dict) -> None:
     try:
-        with open(PDF_CONFIG_PATH, "w", encoding="utf-8") as f:
-            json.dump(mapping, f, ensure_ascii=False, indent=2)
+        routes.save(mapping)
     except Exception:
-        pass
+        logging.exception("Не удалось сохранить %s", routes.config_path)
+
+# --- Загрузка PDF админом ---
+# Каждая загрузка — отдельный файл data/pdf/<слаг>-<хеш>.pdf: файл, который сейчас
+# уходит пользователям, не перезаписывается, а старые версии остаются для отката.
+PDF_STORE_DIR = Path(os.getenv("PDF_STORE_DIR", "data/pdf"))
+# Стандартный Bot API отдаёт боту файлы не больше 20 МБ
+PDF_MAX_SIZE = int(os.getenv("PDF_MAX_SIZE", str(20 * 1024 * 1024)))
+PDF_DOWNLOAD_CHUNK = int(os.getenv("PDF_DOWNLOAD_CHUNK", str(64 * 1024)))
+PDF_DOWNLOAD_TIMEOUT = int(os.getenv("PDF_DOWNLOAD_TIMEOUT", "300"))
+# Сколько версий хранить на каждую цель (текущие файлы из pdf_config.json не удаляются)
+PDF_KEEP_VERSIONS = int(os.getenv("PDF_KEEP_VERSIONS", "5"))
+# По спецификации маркер %%EOF должен быть в последнем килобайте файла
+PDF_TRAILER_WINDOW = 1024
+
+class PdfUploadError(Exception):
+    pass
 
-def get_pdf_path_for_goal(goal: str | None) -> Path:
-    mapping = load_pdf_mapping()
-    default_path = mapping.get("default", "data/презентация.pdf")
-    if goal:
-        path_str = mapping.get(goal, default_path)
+def _pdf_slug(goal: str) -> str:
+    return PDF_GOAL_SLUGS.get(goal) or "goal-" + hashlib.sha256(goal.encode()).hexdigest()[:8]
+
+def pdf_goals(tenant: "Tenant") -> dict[str, str]:
+    """Цели арендатора для /pdf (варианты ответа на вопрос о цели в его анкете и default) -> слаг."""
+    return {goal: _pdf_slug(goal) for goal in tenant.survey.options("goal") + ["default"]}
+
+def pdf_versions(tenant: "Tenant", slug: str) -> list[Path]:
+    """Версии PDF арендатора для слага, от новых к старым."""
+    versions = [path for path in tenant.pdf_dir.glob(f"{slug}-*.pdf") if path.is_file()]
+    return sorted(versions, key=lambda path: path.stat().st_mtime_ns, reverse=True)
+
+def _prune_pdf_versions(tenant: "Tenant", slug: str) -> None:
+    in_use = {Path(str(path)) for path in tenant.pdf_routes.mapping().values()}
+    for path in pdf_versions(tenant, slug)[PDF_KEEP_VERSIONS:]:
+        if path in in_use:
+            continue
+        try:
+            path.unlink()
+            tenant.media_cache.invalidate(path)
+        except OSError:
+            SUPPRESSED_ERRORS.inc("pdf_prune")
+
+def _commit_pdf(tmp_path: Path, dest_path: Path) -> None:
+    with open(tmp_path, "rb") as f:
+        os.fsync(f.fileno())
+    if dest_path.exists():
+        # Такой же файл уже загружали: делаем его самой новой версией
+        tmp_path.unlink()
+        os.utime(dest_path)
+    else:
+        os.replace(tmp_path, dest_path)
+
+async def ingest_pdf(bot: Bot, document, goal: str, tenant: "Tenant") -> Path:
+    """Скачивает PDF потоком во временный файл, проверяет его и атомарно публикует."""
+    if document.file_size and document.file_size > PDF_MAX_SIZE:
+        raise PdfUploadError(f"Файл больше {PDF_MAX_SIZE // (1024 * 1024)} МБ")
+    file = await bot.get_file(document.file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    slug = _pdf_slug(goal)
+    tenant.pdf_dir.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=tenant.pdf_dir, prefix=f".{slug}-", suffix=".part")
+    tmp_path = Path(tmp_name)
+    digest = hashlib.sha256()
+    head = b""
+    tail = b""
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in bot.session.stream_content(url=url, timeout=PDF_DOWNLOAD_TIMEOUT, chunk_size=PDF_DOWNLOAD_CHUNK):
+                size += len(chunk)
+                if size > PDF_MAX_SIZE:
+                    raise PdfUploadError(f"Файл больше {PDF_MAX_SIZE // (1024 * 1024)} МБ")
+                if len(head) < 5:
+                    head += chunk[:5 - len(head)]
+                    if len(head) == 5 and head != b"%PDF-":
+                        raise PdfUploadError("Файл не начинается с заголовка PDF")
+                tail = (tail + chunk)[-PDF_TRAILER_WINDOW:]
+                digest.update(chunk)
+                f.write(chunk)
+        if head != b"%PDF-":
+            raise PdfUploadError("Файл не начинается с заголовка PDF")
+        if b"%%EOF" not in tail:
+            raise PdfUploadError("Файл обрезан: нет маркера конца PDF")
+        dest_path = tenant.pdf_dir / f"{slug}-{digest.hexdigest()[:16]}.pdf"
+        await asyncio.to_thread(_commit_pdf, tmp_path, dest_path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    mapping = tenant.pdf_routes.mapping()
+    mapping[goal] = str(dest_path)
+    save_pdf_mapping(tenant.pdf_routes, mapping)
+    _prune_pdf_versions(tenant, slug)
+    logging.info("[%s] PDF для цели '%s' обновлён: %s (%d байт)", tenant.name, goal, dest_path, size)
+    return dest_path
+
+def rollback_pdf(tenant: "Tenant", goal: str) -> Path | None:
+    """Возвращает цели предыдущую версию PDF; None, если откатываться некуда."""
+    mapping = tenant.pdf_routes.mapping()
+    current = Path(str(mapping[goal])) if goal in mapping else None
+    versions = pdf_versions(tenant, _pdf_slug(goal))
+    if current in versions:
+        older = versions[versions.index(current) + 1:]
     else:
-        path_str = default_path
-    return Path(path_str)
+        older = versions
+    if not older:
+        return None
+    mapping[goal] = str(older[0])
+    save_pdf_mapping(tenant.pdf_routes, mapping)
+    return older[0]
+
+class PdfUploads:
+    """Загрузки PDF идут фоновыми задачами и не занимают обработчики обновлений."""
+
+    def __init__(self):
+        self._tasks: set[asyncio.Task] = set()
+
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, bot: Bot, chat_id: int, document, goal: str, tenant: "Tenant") -> None:
+        task = asyncio.create_task(self._run(bot, chat_id, document, goal, tenant))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, bot: Bot, chat_id: int, document, goal: str, tenant: "Tenant") -> None:
+        try:
+            path = await ingest_pdf(bot, document, goal, tenant)
+            text = f"Файл сохранён для цели '{goal}': {path}\nГотово. Вернуть прежний: /pdf_rollback {_pdf_slug(goal)}"
+        except PdfUploadError as e:
+            text = f"PDF не принят: {e}"
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("[%s] Не удалось загрузить PDF для цели '%s'", tenant.name, goal)
+            text = "Не удалось сохранить файл. Попробуйте позже."
+        try:
+            await bot.send_message(chat_id, html.escape(text))
+        except Exception:
+            SUPPRESSED_ERRORS.inc("pdf_upload_reply")
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+pdf_uploads = PdfUploads()
+metrics.register(Gauge("pdf_uploads_inflight", "Загрузки PDF в процессе", pdf_uploads.pending))
+
+# --- Арендаторы ---
+# Один процесс обслуживает несколько ботов (брокеров). У каждого арендатора свои токен,
+# таблица, админы, анкета с текстами, PDF по целям и кэш file_id; цикл событий,
+# HTTP-сессия Bot API, клиент Google, хранилище и фоновые воркеры — общие.
+# Без tenants.json работает один арендатор "default" из прежних переменных окружения.
+TENANTS_CONFIG_PATH = Path(os.getenv("TENANTS_CONFIG_PATH", "tenants.json"))
+# Каталог для файлов арендаторов, пути которых не заданы в конфиге явно
+TENANTS_DATA_DIR = Path(os.getenv("TENANTS_DATA_DIR", "data/tenants"))
+DEFAULT_TENANT = "default"
+_TENANT_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+class Tenant:
+    """Настройки и состояние одного бота; всё остальное в процессе общее."""
+
+    def __init__(self, name: str, token: str | None, sheet_id: str | None, admin_ids: set[int],
+                 survey_path: Path, pdf_config_path: Path, default_pdf_path: Path, pdf_dir: Path,
+                 media_cache_path: Path, image_path: Path, shard_by: str = SHEET_SHARD_BY):
+        if not _TENANT_NAME.match(name):
+            raise ValueError(f"Недопустимое имя арендатора: '{name}'")
+        self.name = name
+        self.token = token
+        self.admin_ids = admin_ids
+        self.image_path = image_path
+        self.pdf_dir = pdf_dir
+        self.survey = SurveyEngine(survey_path)
+        self.pdf_routes = PdfRoutes(pdf_config_path, default_pdf_path)
+        self.media_cache = MediaCache(media_cache_path)
+        self.sheets = SheetsClient(opener=functools.partial(_open_sheet, sheet_id))
+        self.shards = SheetShards(shard_by)
+        self.index = LeadIndex(lead_store, name)
+        self.bot: Bot | None = None
+
+    def is_admin(self, user_id: int | None) -> bool:
+        return bool(user_id and user_id in self.admin_ids)
+
+    @property
+    def webhook_path(self) -> str:
+        # Прежний путь вебхука остаётся за арендатором по умолчанию
+        if self.name == DEFAULT_TENANT:
+            return WEBHOOK_PATH
+        return f"{WEBHOOK_PATH.rstrip('/')}/{self.name}"
+
+    @classmethod
+    def from_env(cls) -> "Tenant":
+        return cls(
+            DEFAULT_TENANT, TOKEN, SHEET_ID, ADMIN_IDS,
+            survey_path=SURVEY_CONFIG_PATH,
+            pdf_config_path=PDF_CONFIG_PATH,
+            default_pdf_path=Path(DEFAULT_PDF_PATH),
+            pdf_dir=PDF_STORE_DIR,
+            media_cache_path=MEDIA_CACHE_PATH,
+            image_path=Path("data/image.png"),
+        )
+
+    @classmethod
+    def from_config(cls, name: str, spec: dict) -> "Tenant":
+        token = spec.get("token") or os.getenv(spec.get("token_env", ""), "")
+        # Без своей таблицы лиды арендатора ушли бы в чужую, поэтому SHEET_ID здесь не подставляем
+        sheet_id = spec.get("sheet_id")
+        if not sheet_id:
+            raise ValueError(f"У арендатора '{name}' не задан sheet_id")
+        admin_ids = spec.get("admin_ids", [])
+        if isinstance(admin_ids, str):
+            admin_ids = _parse_admin_ids(admin_ids)
+        data_dir = TENANTS_DATA_DIR / name
+        return cls(
+            name, token, sheet_id, {int(i) for i in admin_ids},
+            survey_path=Path(spec.get("survey", SURVEY_CONFIG_PATH)),
+            pdf_config_path=Path(spec.get("pdf_config", data_dir / "pdf_config.json")),
+            default_pdf_path=Path(spec.get("default_pdf", DEFAULT_PDF_PATH)),
+            pdf_dir=Path(spec.get("pdf_dir", data_dir / "pdf")),
+            media_cache_path=Path(spec.get("media_cache", data_dir / "media_cache.json")),
+            image_path=Path(spec.get("image", "data/image.png")),
+            shard_by=spec.get("shard_by", SHEET_SHARD_BY),
+        )
+
+class TenantRegistry:
+    def __init__(self, items: list[Tenant]):
+        if not items:
+            raise ValueError("Не задано ни одного арендатора")
+        self._by_name = {tenant.name: tenant for tenant in items}
+        if len(self._by_name) != len(items):
+            raise ValueError("Имена арендаторов повторяются")
+        self._by_bot: dict[int, Tenant] = {}
+
+    @classmethod
+    def load(cls, path: Path = TENANTS_CONFIG_PATH) -> "TenantRegistry":
+        if not path.exists():
+            return cls([Tenant.from_env()])
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        return cls([Tenant.from_config(name, spec) for name, spec in config["tenants"].items()])
+
+    def all(self) -> list[Tenant]:
+        return list(self._by_name.values())
+
+    def get(self, name: str) -> Tenant | None:
+        return self._by_name.get(name)
+
+    def bind(self, tenant: Tenant, bot: Bot) -> Bot:
+        if bot.id in self._by_bot:
+            raise ValueError(f"Токен арендатора '{tenant.name}' уже используется")
+        tenant.bot = bot
+        self._by_bot[bot.id] = tenant
+        return bot
+
+    def for_bot(self, bot: Bot) -> Tenant:
+        return self._by_bot[bot.id]
+
+tenants = TenantRegistry.load()
+metrics.register(Gauge("lead_index_entries", "Записи индекса дедупликации",
+                       lambda: sum(len(tenant.index) for tenant in tenants.all())))
+
+class TenantMiddleware(BaseMiddleware):
+    """Передаёт хендлерам и остальным middleware арендатора бота, получившего обновление."""
+
+    async def __call__(self, handler, event, data):
+        data["tenant"] = tenants.for_bot(data["bot"])
+        return await handler(event, data)
 
 # --- Отложённое сохранение частичных данных ---
-PENDING_SAVE_TASKS: dict[int, asyncio.Task] = {}
 
 def _format_username(user) -> str:
     if user and getattr(user, "username", None):
         return f"@{user.username}"
     return ""
 
-def cancel_partial_save(user_id: int) -> None:
-    task = PENDING_SAVE_TASKS.pop(user_id, None)
-    if task and not task.done():
-        task.cancel()
+def _new_lead_key(tenant: Tenant, user_id: int | None) -> str:
+    # Ключ идемпотентности лида: один проход анкеты — одна запись
+    return f"{tenant.name}:{user_id or 0}:{time.time_ns() // 1_000_000}"
+
+def _lead_fields(data: dict) -> dict:
+    return {name: data.get(name, "") for name in LEAD_FIELDS}
+
+def _lead_summary(title: str, data: dict) -> str:
+    # Бот шлёт с parse_mode=HTML: один неэкранированный ответ уронил бы всю пачку уведомлений
+    values = {name: html.escape(str(data.get(name, ""))) for name in LEAD_FIELDS}
+    return (
+        f"{title}:\n"
+        f"Имя: {values['name']}\n"
+        f"Логин: {values['username']}\n"
+        f"Бюджет: {values['budget']}\n"
+        f"Цель: {values['goal']}\n"
+        f"Сроки: {values['timing']}\n"
+        f"Телефон: {values['phone']}"
+    )
+
+async def save_lead(tenant: Tenant, user_id: int | None, data: dict, complete: bool) -> None:
+    key = data.get("lead_key") or _new_lead_key(tenant, user_id)
+    await sheet_writer.submit(key, tenant.name, user_id, _lead_fields(data), complete)
+    LEADS_SAVED.inc(tenant.name, "complete" if complete else "partial")
+
+class PartialSaveScheduler:
+    """Один таймер на все отложенные сохранения вместо задачи на каждого пользователя.
+
+    Дедлайны лежат в куче; перенос дедлайна — O(log n), устаревшие записи кучи
+    отбрасываются лениво. Истёкшие дедлайны срабатывают пачкой. Ключ — (арендатор, user_id).
+    """
+
+    def __init__(self, timeout: float, on_expire):
+        self.timeout = timeout
+        self.on_expire = on_expire
+        self._heap: list[tuple[float, int, tuple[str, int]]] = []
+        self._entries: dict[tuple[str, int], tuple[float, int, FSMContext, Bot]] = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
 
-def schedule_partial_save(user_id: int, state: FSMContext, bot: Bot) -> None:
-    cancel_partial_save(user_id)
-    PENDING_SAVE_TASKS[user_id] = asyncio.create_task(_partial_save_task(user_id, state, bot))
+    def pending(self) -> int:
+        return len(self._entries)
 
-async def _partial_save_task(user_id: int, state: FSMContext, bot: Bot) -> None:
-    current_task = asyncio.current_task()
+    def schedule(self, key: tuple[str, int], state: FSMContext, bot: Bot, delay: float | None = None) -> None:
+        deadline = asyncio.get_running_loop().time() + (self.timeout if delay is None else delay)
+        seq = next(self._seq)
+        self._entries[key] = (deadline, seq, state, bot)
+        heapq.heappush(self._heap, (deadline, seq, key))
+        # Куча разрастается из-за перенесённых дедлайнов — периодически пересобираем
+        if len(self._heap) > 2 * len(self._entries) + 1024:
+            self._heap = [(d, s, key) for key, (d, s, _, _) in self._entries.items()]
+            heapq.heapify(self._heap)
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def cancel(self, key: tuple[str, int]) -> None:
+        self._entries.pop(key, None)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Останавливает таймер; снимки анкет остаются в хранилище до следующего запуска."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    def _pop_expired(self, now: float) -> list[tuple[tuple[str, int], FSMContext, Bot]]:
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            _, seq, key = heapq.heappop(self._heap)
+            entry = self._entries.get(key)
+            if entry is None or entry[1] != seq:
+                continue  # дедлайн перенесён или отменён
+            del self._entries[key]
+            expired.append((key, entry[2], entry[3]))
+        return expired
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            # Снимаем с вершины кучи отменённые записи, чтобы не просыпаться зря
+            while self._heap and self._entries.get(self._heap[0][2], (0, -1))[1] != self._heap[0][1]:
+                heapq.heappop(self._heap)
+            timeout = self._heap[0][0] - loop.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            expired = self._pop_expired(loop.time())
+            if expired:
+                task = asyncio.create_task(self._fire(expired))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+    async def _fire(self, expired: list[tuple[tuple[str, int], FSMContext, Bot]]) -> None:
+        results = await asyncio.gather(*(self.on_expire(*item) for item in expired), return_exceptions=True)
+        for ((tenant_name, user_id), _, _), result in zip(expired, results):
+            if isinstance(result, Exception):
+                logging.error("[%s] Не удалось сохранить незавершённую анкету пользователя %s", tenant_name, user_id, exc_info=result)
+
+async def _save_partial(key: tuple[str, int], state: FSMContext, bot: Bot) -> None:
+    tenant_name, user_id = key
+    # Таймер локальный, а анкету могли продолжить на другой реплике: решает дедлайн в базе
+    now = time.time()
+    if not await lead_store.claim_pending(tenant_name, user_id, now, now + PARTIAL_SAVE_TIMEOUT):
+        deadline = await lead_store.pending_deadline(tenant_name, user_id)
+        if deadline is not None:
+            # Дедлайн сдвинут — ждём его; снимка нет — анкету уже сохранили или завершили
+            partial_saves.schedule(key, state, bot, delay=max(0.0, deadline - now))
+        return
+    data = await state.get_data()
+    if not data:
+        await lead_store.drop_pending(tenant_name, user_id)
+        return
+    await save_lead(tenants.for_bot(bot), user_id, data, complete=False)
+    # Уведомляем админов об незавершённой анкете
+    notify_admins(bot, _lead_summary(f"Незавершенная анкета (таймаут {PARTIAL_SAVE_TIMEOUT}с)", data))
+    # Очищаем состояние пользователя после автосохранения
     try:
-        await asyncio.sleep(60)
+        await state.clear()
+    except Exception:
+        SUPPRESSED_ERRORS.inc("partial_state_clear")
+    await lead_store.drop_pending(tenant_name, user_id)
+
+partial_saves = PartialSaveScheduler(PARTIAL_SAVE_TIMEOUT, _save_partial)
+metrics.register(Gauge("partial_saves_pending", "Анкеты, ожидающие автосохранения", partial_saves.pending))
+
+async def cancel_partial_save(tenant: Tenant, user_id: int) -> None:
+    partial_saves.cancel((tenant.name, user_id))
+    await lead_store.drop_pending(tenant.name, user_id)
+
+async def schedule_partial_save(tenant: Tenant, user_id: int, state: FSMContext, bot: Bot, data: dict | None = None) -> None:
+    # Снимок анкеты переживёт перезапуск контейнера
+    if data is None:
         data = await state.get_data()
-        if not data:
-            return
-        row = [
-            data.get("name", ""),
-            data.get("username", ""),
-            data.get("budget", ""),
-            data.get("goal", ""),
-            data.get("timing", ""),
-            data.get("phone", ""),
-        ]
-        try:
-            sheet.append_row(row)
-        except Exception:
-            pass
-        # Уведомляем админов об незавершённой анкете
-        try:
-            summary = (
-                "Незавершенная анкета (таймаут 60с):\n"
-                f"Имя: {data.get('name','')}\n"
-                f"Логин: {data.get('username','')}\n"
-                f"Бюджет: {data.get('budget','')}\n"
-                f"Цель: {data.get('goal','')}\n"
-                f"Сроки: {data.get('timing','')}\n"
-                f"Телефон: {data.get('phone','')}"
-            )
-            await notify_admins(bot, summary)
-        except Exception:
-            pass
-        # Очищаем состояние пользователя после автосохранения
-        try:
-            await state.clear()
-        except Exception:
-            pass
-    except asyncio.CancelledError:
-        return
-    finally:
-        # Удаляем только если задача всё ещё актуальная для user_id
+    await lead_store.save_pending(tenant.name, user_id, data, time.time() + PARTIAL_SAVE_TIMEOUT)
+    partial_saves.schedule((tenant.name, user_id), state, bot)
+
+async def recover_pending_partials(tenant: Tenant) -> None:
+    """Возвращает в таймер анкеты, прерванные перезапуском.
+
+    Состояние FSM хранится в базе, поэтому пользователь может продолжить анкету.
+    Если состояние уже удалено, сохраняем снимок анкеты сразу.
+    """
+    bot = tenant.bot
+    for user_id, raw, deadline in await lead_store.list_pending(tenant.name):
         try:
-            if PENDING_SAVE_TASKS.get(user_id) is current_task:
-                PENDING_SAVE_TASKS.pop(user_id, None)
+            # Анкета идёт в личном чате, поэтому chat_id совпадает с user_id
+            state = FSMContext(storage=fsm_storage, key=StorageKey(bot_id=bot.id, chat_id=user_id, user_id=user_id))
+            if await state.get_data():
+                partial_saves.schedule((tenant.name, user_id), state, bot, delay=max(0.0, deadline - time.time()))
+                continue
+            data = json.loads(raw)
+            await save_lead(tenant, user_id, data, complete=False)
+            notify_admins(bot, _lead_summary("Незавершенная анкета (перезапуск бота)", data))
         except Exception:
-            pass
+            logging.exception("[%s] Не удалось восстановить анкету пользователя %s", tenant.name, user_id)
+            continue
+        await lead_store.drop_pending(tenant.name, user_id)
 
-async def notify_admins(bot: Bot, text: str) -> None:
-    if not ADMIN_IDS:
-        return
-    for admin_id in ADMIN_IDS:
+# --- Очередь исходящих сообщений ---
+# Лимиты Telegram: ~30 сообщений в секунду на бота и около одного в секунду в один чат
+# (короткие всплески в личке допустимы). Все запросы с chat_id проходят через общую
+# очередь с приоритетами; 0 в *_RATE отключает соответствующий лимит.
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_GLOBAL_BURST = float(os.getenv("SEND_GLOBAL_BURST", "30"))
+SEND_PER_CHAT_RATE = float(os.getenv("SEND_PER_CHAT_RATE", "1"))
+SEND_PER_CHAT_BURST = float(os.getenv("SEND_PER_CHAT_BURST", "4"))
+# Сколько раз повторять запрос после 429 RetryAfter
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+SEND_MAX_CHATS = int(os.getenv("SEND_MAX_CHATS", "100000"))
+
+# Чем меньше число, тем раньше уходит запрос
+SEND_PRIORITY_INTERACTIVE = 0
+SEND_PRIORITY_DOCUMENT = 1
+SEND_PRIORITY_ADMIN = 2
+SEND_PRIORITY_NAMES = ("interactive", "document", "admin")
+# Приоритет задаётся для всей задачи: например, рассыльщик уведомлений ставит себе admin
+send_priority: contextvars.ContextVar[int] = contextvars.ContextVar("send_priority", default=SEND_PRIORITY_INTERACTIVE)
+
+SEND_QUEUE_WAIT = metrics.register(Histogram("telegram_send_queue_wait_seconds", "Ожидание в очереди исходящих сообщений", ("priority",)))
+SEND_RETRIES = metrics.register(Counter("telegram_send_retries_total", "Повторы запросов после RetryAfter", ("priority",)))
+
+class _TokenBucket:
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        # Пользователю уже ответили, что он ограничен: до следующего пропуска молчим
+        self.warned = False
+
+    def take(self, cost: float, rate: float, burst: float, now: float) -> bool:
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def reserve(self, cost: float, rate: float, burst: float, now: float) -> float:
+        """Списывает токены в долг и возвращает, сколько секунд подождать до их появления."""
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate) - cost
+        self.updated = now
+        return 0.0 if self.tokens >= 0 else -self.tokens / rate
+
+class _SendLane:
+    """Очередь одного бота: общий лимит Telegram и пауза после 429 действуют на токен."""
+
+    __slots__ = ("bucket", "queue", "wakeup", "paused_until", "task")
+
+    def __init__(self, burst: float, now: float):
+        self.bucket = _TokenBucket(burst, now)
+        # (приоритет, порядковый номер, future)
+        self.queue: list[tuple[int, int, asyncio.Future]] = []
+        self.wakeup = asyncio.Event()
+        self.paused_until = 0.0
+        self.task: asyncio.Task | None = None
+
+    def release(self) -> None:
+        while self.queue:
+            _, _, waiter = heapq.heappop(self.queue)
+            if not waiter.done():
+                waiter.set_result(None)
+
+class SendShaper(BaseRequestMiddleware):
+    """Общая очередь исходящих запросов к Bot API: лимиты, приоритеты и повторы после 429.
+
+    Сначала запрос ждёт токен своего чата, затем встаёт в кучу своего бота по приоритету;
+    фоновая задача бота выпускает запросы из кучи с общей скоростью. Пока очередь
+    не запущена (или уже остановлена), запросы идут напрямую.
+    """
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, global_burst: float = SEND_GLOBAL_BURST,
+                 per_chat_rate: float = SEND_PER_CHAT_RATE, per_chat_burst: float = SEND_PER_CHAT_BURST,
+                 max_chats: int = SEND_MAX_CHATS):
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_chats = max_chats
+        self._lanes: dict[int, _SendLane] = {}
+        # Ключ — (id бота, chat_id): один и тот же пользователь в разных ботах — разные чаты
+        self._chats: OrderedDict[tuple[int, int | str], _TokenBucket] = OrderedDict()
+        self._seq = itertools.count()
+        self._running = False
+
+    def pending(self) -> int:
+        return sum(len(lane.queue) for lane in self._lanes.values())
+
+    def start(self) -> None:
+        self._running = True
+
+    async def stop(self) -> None:
+        if not self._running:
+            return
+        self._running = False
+        lanes = list(self._lanes.values())
+        self._lanes.clear()
+        for lane in lanes:
+            if lane.task is not None:
+                lane.task.cancel()
+        await asyncio.gather(*(lane.task for lane in lanes if lane.task is not None), return_exceptions=True)
+        # Ожидающие запросы отпускаем: дальше всё идёт напрямую
+        for lane in lanes:
+            lane.task = None
+            lane.release()
+
+    def _lane(self, bot: Bot) -> _SendLane:
+        lane = self._lanes.get(bot.id)
+        if lane is None:
+            lane = self._lanes[bot.id] = _SendLane(self.global_burst, time.monotonic())
+            lane.task = asyncio.create_task(self._run(lane))
+        return lane
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if not self._running:
+            return await make_request(bot, method)
+        lane = self._lane(bot)
+        # В очередь встают только сообщения в чаты; остальные методы (answerCallbackQuery,
+        # getFile и т. п.) лимитами не шейпим, но после 429 тоже повторяем
+        chat_id = getattr(method, "chat_id", None)
+        priority = send_priority.get()
+        if isinstance(method, SendDocument):
+            priority = max(priority, SEND_PRIORITY_DOCUMENT)
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            if chat_id is not None:
+                await self._acquire(lane, (bot.id, chat_id), priority)
+            elif lane.paused_until > time.monotonic():
+                await asyncio.sleep(lane.paused_until - time.monotonic())
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as exc:
+                if attempt >= SEND_MAX_RETRIES or not self._running:
+                    raise
+                SEND_RETRIES.inc(SEND_PRIORITY_NAMES[priority])
+                logging.warning("Telegram просит подождать %s с (%s в чат %s)", exc.retry_after, type(method).__name__, chat_id)
+                # Флуд-лимит общий для бота: приостанавливаем всю его очередь
+                lane.paused_until = max(lane.paused_until, time.monotonic() + exc.retry_after)
+                lane.wakeup.set()
+
+    def _chat_bucket(self, key: tuple[int, int | str], now: float) -> _TokenBucket:
+        bucket = self._chats.get(key)
+        if bucket is not None:
+            self._chats.move_to_end(key)
+            return bucket
+        bucket = self._chats[key] = _TokenBucket(self.per_chat_burst, now)
+        if len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+        return bucket
+
+    async def _acquire(self, lane: _SendLane, key: tuple[int, int | str], priority: int) -> None:
+        started = time.monotonic()
+        if self.per_chat_rate > 0:
+            delay = self._chat_bucket(key, started).reserve(1.0, self.per_chat_rate, self.per_chat_burst, started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if lane.task is not None:
+            waiter = asyncio.get_running_loop().create_future()
+            heapq.heappush(lane.queue, (priority, next(self._seq), waiter))
+            lane.wakeup.set()
+            await waiter
+        SEND_QUEUE_WAIT.observe(time.monotonic() - started, SEND_PRIORITY_NAMES[priority])
+
+    async def _run(self, lane: _SendLane) -> None:
+        while True:
+            if not lane.queue:
+                lane.wakeup.clear()
+                await lane.wakeup.wait()
+                continue
+            now = time.monotonic()
+            if lane.paused_until > now:
+                await asyncio.sleep(lane.paused_until - now)
+                continue
+            if self.global_rate > 0:
+                delay = lane.bucket.reserve(1.0, self.global_rate, self.global_burst, now)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # После ожидания берём самый приоритетный из тех, кто ещё ждёт
+            while lane.queue:
+                _, _, waiter = heapq.heappop(lane.queue)
+                if not waiter.done():
+                    waiter.set_result(None)
+                    break
+
+send_shaper = SendShaper()
+metrics.register(Gauge("telegram_send_queue", "Запросы в очереди исходящих сообщений", send_shaper.pending))
+
+# --- Уведомления админам ---
+# Скорость и повторы после 429 обеспечивает очередь исходящих сообщений,
+# уведомления в ней идут с самым низким приоритетом.
+# Если в очереди накопилось несколько анкет, склеиваем их в одно сообщение (0 — выключено)
+NOTIFY_DIGEST = os.getenv("NOTIFY_DIGEST", "1") not in ("0", "false", "no", "")
+NOTIFY_DIGEST_MAX = int(os.getenv("NOTIFY_DIGEST_MAX", "20"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def _build_digest(texts: list[str]) -> list[str]:
+    """Склеивает уведомления в сообщения, не превышающие лимит Telegram."""
+    if len(texts) == 1:
+        return texts
+    header = f"Анкет в пачке: {len(texts)}\n\n"
+    chunks: list[str] = []
+    current = header
+    for text in texts:
+        piece = text + "\n\n"
+        if len(current) + len(piece) > TELEGRAM_MESSAGE_LIMIT and current != header:
+            chunks.append(current.rstrip())
+            current = ""
+        current += piece
+    if current.strip():
+        chunks.append(current.rstrip())
+    return chunks
+
+class AdminNotifier:
+    """Рассылает уведомления админам в фоне, не задерживая ответы пользователю."""
+
+    def __init__(self):
+        self.queue: asyncio.Queue[tuple[Bot, str] | None] = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+
+    def submit(self, bot: Bot, text: str) -> None:
+        if tenants.for_bot(bot).admin_ids:
+            self.queue.put_nowait((bot, text))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Досылает накопившиеся уведомления и останавливает рассылку."""
+        if self._task is None:
+            return
+        self.queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def _run(self) -> None:
+        send_priority.set(SEND_PRIORITY_ADMIN)
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            while NOTIFY_DIGEST and len(batch) < NOTIFY_DIGEST_MAX and not self.queue.empty():
+                extra = self.queue.get_nowait()
+                if extra is None:
+                    stopping = True
+                    break
+                batch.append(extra)
+            # Склеиваем только уведомления одного бота: у каждого арендатора свои админы
+            by_bot: dict[int, tuple[Bot, list[str]]] = {}
+            for bot, text in batch:
+                by_bot.setdefault(id(bot), (bot, []))[1].append(text)
+            for bot, texts in by_bot.values():
+                for text in (_build_digest(texts) if NOTIFY_DIGEST else texts):
+                    await self._broadcast(bot, text)
+            if stopping:
+                return
+
+    async def _broadcast(self, bot: Bot, text: str) -> None:
+        admin_ids = tenants.for_bot(bot).admin_ids
+        await asyncio.gather(*(self._send(bot, admin_id, text) for admin_id in admin_ids))
+
+    async def _send(self, bot: Bot, chat_id: int, text: str) -> None:
         try:
-            await bot.send_message(chat_id=admin_id, text=text)
+            await bot.send_message(chat_id=chat_id, text=text)
         except Exception:
-            continue
+            SUPPRESSED_ERRORS.inc("admin_notify")
+            logging.exception("Не удалось отправить уведомление админу %s: %s", chat_id, text)
+
+admin_notifier = AdminNotifier()
+metrics.register(Gauge("admin_notify_queue", "Уведомления админам в очереди", lambda: admin_notifier.queue.qsize()))
+
+def notify_admins(bot: Bot, text: str) -> None:
+    admin_notifier.submit(bot, text)
 
 # --- Обработчики ---
-async def cmd_start(message: Message, state: FSMContext):
-    await state.clear()
-    img_path = Path("data/image.png")
+async def cmd_start(message: Message, state: FSMContext, tenant: Tenant):
+    user_id = message.from_user.id if message.from_user else None
+    funnel = tenant.survey.pick(user_id)
+    SURVEY_STEPS.inc(tenant.name, funnel.name, "start")
+    img_path = tenant.image_path
     if img_path.exists():
         try:
-            await message.answer_photo(photo=FSInputFile(str(img_path)), caption=INTRO_TEXT)
+            await send_cached_media(tenant.media_cache, img_path, lambda photo: message.answer_photo(photo=photo, caption=funnel.intro))
         except Exception:
-            await message.answer(INTRO_TEXT)
+            SUPPRESSED_ERRORS.inc("intro_photo")
+            await message.answer(funnel.intro)
     else:
-        await message.answer(INTRO_TEXT)
-    # Отдельным сообщением спрашиваем имя
-    await message.answer("Напишите, пожалуйста, Ваше имя")
-    # Сохраняем логин пользователя для таблицы
-    await state.update_data(username=_format_username(message.from_user))
+        await message.answer(funnel.intro)
+    # Логин пользователя для таблицы и ключ идемпотентности лида; прежняя анкета затирается
+    data = {"username": _format_username(message.from_user), "lead_key": _new_lead_key(tenant, user_id)}
+    first = funnel.steps[0]
+    await state.storage.set_state_and_data(state.key, first.state, data)
+    # Первый вопрос — отдельным сообщением
+    await message.answer(first.render(data), reply_markup=first.markup)
     # Планируем отложенное сохранение частичных данных
-    if message.from_user and message.from_user.id:
-        schedule_partial_save(message.from_user.id, state, message.bot)
-    await state.set_state(Survey.name)
+    if user_id:
+        await schedule_partial_save(tenant, user_id, state, message.bot, data)
 
-def make_pdf_goals_kb() -> InlineKeyboardMarkup:
+def make_pdf_goals_kb(tenant: Tenant) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=k, callback_data=f"pdfgoal:{k}")] for k in PDF_GOAL_SLUGS.keys()
+        [InlineKeyboardButton(text=goal, callback_data=PdfGoalChoice(slug=slug).pack())]
+        for goal, slug in pdf_goals(tenant).items()
     ])
 
-async def admin_pdf_start(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def admin_pdf_start(message: Message, state: FSMContext, tenant: Tenant):
+    if not tenant.is_admin(message.from_user.id):
         return
-    mapping = load_pdf_mapping()
+    mapping = tenant.pdf_routes.mapping()
     current = json.dumps(mapping, ensure_ascii=False, indent=2) if mapping else "(пока не задано, по умолчанию data/презентация.pdf)"
     await state.set_state(PdfSetup.choose_goal)
-    await message.answer("Выберите цель, для которой хотите загрузить новый PDF.\n\nТекущие значения:\n" + current, reply_markup=make_pdf_goals_kb())
+    await message.answer("Выберите цель, для которой хотите загрузить новый PDF.\n\nТекущие значения:\n" + current, reply_markup=make_pdf_goals_kb(tenant))
 
 def _parse_pdf_mapping_lines(text: str) -> dict[str, str]:
     result: dict[str, str] = {}
@@ -320,22 +2452,18 @@ def _parse_pdf_mapping_lines(text: str) -> dict[str, str]:
             result[key] = val
     return result
 
-async def on_pdf_goal_selected(cq: CallbackQuery, state: FSMContext):
-    if not is_admin(cq.from_user.id):
-        await cq.answer()
-        return
-    try:
-        _, goal = cq.data.split(":", 1)
-    except Exception:
+async def on_pdf_goal_selected(cq: CallbackQuery, callback_data: PdfGoalChoice, state: FSMContext, tenant: Tenant):
+    goal = next((g for g, slug in pdf_goals(tenant).items() if slug == callback_data.slug), None)
+    if not tenant.is_admin(cq.from_user.id) or goal is None:
         await cq.answer()
         return
     await state.update_data(pdf_goal=goal)
     await state.set_state(PdfSetup.waiting_file)
-    await cq.message.edit_text(f"Цель: {goal}\n\nПришлите PDF-файл (документ) для этой цели. Прежний файл будет заменён.")
+    await cq.message.edit_text(f"Цель: {goal}\n\nПришлите PDF-файл (документ) для этой цели. Прежний файл сохранится, вернуть его можно через /pdf_rollback.")
     await cq.answer()
 
-async def admin_pdf_receive_document(message: Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def admin_pdf_receive_document(message: Message, state: FSMContext, tenant: Tenant):
+    if not tenant.is_admin(message.from_user.id):
         await state.clear()
         return
     data = await state.get_data()
@@ -347,172 +2475,409 @@ async def admin_pdf_receive_document(message: Message, state: FSMContext):
     if not getattr(message, "document", None):
         await message.answer("Пожалуйста, пришлите PDF-файл как документ.")
         return
-    # Проверим тип
+    # Тип файла — только подсказка; содержимое проверяется при загрузке
     mime = getattr(message.document, "mime_type", "") or ""
     if "pdf" not in mime.lower():
         await message.answer("Это не похоже на PDF. Пришлите документ с типом PDF.")
         return
-    # Определим путь сохранения
-    slug = PDF_GOAL_SLUGS.get(goal, "custom")
-    Path("data").mkdir(parents=True, exist_ok=True)
-    dest_path = Path(f"data/pdf_{slug}.pdf")
-    try:
-        await message.bot.download(file=message.document, destination=dest_path)
-        mapping = load_pdf_mapping()
-        mapping[goal] = str(dest_path)
-        save_pdf_mapping(mapping)
-        await message.answer(f"Файл сохранён для цели '{goal}': {dest_path}\nГотово.")
-    except Exception:
-        await message.answer("Не удалось сохранить файл. Попробуйте позже.")
-    finally:
-        await state.clear()
-
-async def survey_name(message: Message, state: FSMContext):
-    user_name = message.text.strip()
-    await state.update_data(name=user_name)
-    greet_text = (
-        f"Рада знакомству с Вами, {user_name}! \n\n"
-        "Подскажите, пожалуйста, какой бюджет вы рассматриваете для покупки 💰 — это поможет сразу показать объекты с максимальной доходностью и комфортом."
-    )
-    await message.answer(greet_text, reply_markup=make_budget_kb())
-    # Перепланируем отложенное сохранение
-    if message.from_user and message.from_user.id:
-        schedule_partial_save(message.from_user.id, state, message.bot)
-    await state.set_state(Survey.budget)
+    pdf_uploads.submit(message.bot, message.chat.id, message.document, goal, tenant)
+    await message.answer(f"Загружаю файл для цели '{html.escape(goal)}', сообщу, когда он будет готов.")
+    await state.clear()
 
-async def on_budget_selected(cq: CallbackQuery, state: FSMContext):
-    try:
-        _, value = cq.data.split(":", 1)
-    except Exception:
-        await cq.answer()
+async def admin_pdf_rollback(message: Message, tenant: Tenant):
+    if not tenant.is_admin(message.from_user.id):
         return
-    await state.update_data(budget=value)
-    await state.set_state(Survey.goal)
-    await cq.message.edit_text(
-        "Благодарю за ответ 🌿\n\nЕще важный вопрос — это цель покупки, от нее мы прокладываем стратегию.\n\nДля какой цели выбираете объекты?",
-        reply_markup=make_goal_kb(),
-    )
-    # Перепланируем отложенное сохранение
-    schedule_partial_save(cq.from_user.id, state, cq.message.bot)
-    await cq.answer()
-
-async def on_goal_selected(cq: CallbackQuery, state: FSMContext):
-    try:
-        _, value = cq.data.split(":", 1)
-    except Exception:
-        await cq.answer()
+    arg = (message.text or "").partition(" ")[2].strip()
+    # Цель можно указать и названием, и слагом
+    goals = pdf_goals(tenant)
+    goal = arg if arg in goals else next((g for g, slug in goals.items() if slug == arg), None)
+    if goal is None:
+        slugs = ", ".join(goals.values())
+        await message.answer(f"Укажите цель: /pdf_rollback &lt;слаг&gt;\nСлаги: {slugs}")
         return
-    await state.update_data(goal=value)
-    await state.set_state(Survey.timing)
-    await cq.message.edit_text(
-        "На нашем рынке нередко появляются сильные предложения, и важно быть к ним готовыми ⚡️\n\nЧтобы я могла подобрать для вас лучшее — подскажите, пожалуйста, в какие сроки планируете покупку недвижимости?",
-        reply_markup=make_timing_kb(),
-    )
-    # Перепланируем отложенное сохранение
-    schedule_partial_save(cq.from_user.id, state, cq.message.bot)
-    await cq.answer()
+    path = rollback_pdf(tenant, goal)
+    if path is None:
+        await message.answer(f"Для цели '{html.escape(goal)}' нет более старой версии.")
+        return
+    await message.answer(f"Для цели '{html.escape(goal)}' возвращён файл {path}")
 
-async def on_timing_selected(cq: CallbackQuery, state: FSMContext):
-    try:
-        _, value = cq.data.split(":", 1)
-    except Exception:
-        await cq.answer()
+async def _advance_survey(tenant: Tenant, funnel: SurveyFunnel, step: SurveyStep, value: str, state: FSMContext,
+                          user_id: int | None, message: Message, edit: bool) -> None:
+    """Записывает ответ и задаёт следующий вопрос; после последнего шага сохраняет лид."""
+    SURVEY_STEPS.inc(tenant.name, funnel.name, step.id)
+    data = await state.get_data()
+    data[step.field] = value
+    next_step = funnel.next_step(step)
+    if next_step is None:
+        await _finish_survey(tenant, funnel, data, state, user_id, message)
         return
-    await state.update_data(timing=value)
-    await state.set_state(Survey.phone)
-    await cq.message.edit_text(
-        "Все мои клиенты 🥰 в числе первых, кто узнаёт о горячих предложениях.\n\nОставьте, пожалуйста, номер телефона в формате +7XXXXXXXXXX (можно 8XXXXXXXXXX) — и я буду держать вас в курсе 💪"
-    )
+    await state.storage.set_state_and_data(state.key, next_step.state, data)
+    if edit:
+        await message.edit_text(next_step.render(data), reply_markup=next_step.markup)
+    else:
+        await message.answer(next_step.render(data), reply_markup=next_step.markup)
     # Перепланируем отложенное сохранение
-    schedule_partial_save(cq.from_user.id, state, cq.message.bot)
-    await cq.answer()
+    if user_id:
+        await schedule_partial_save(tenant, user_id, state, message.bot, data)
 
-async def survey_phone(message: Message, state: FSMContext):
-    raw_phone = (message.text or "").strip()
-    normalized = normalize_phone(raw_phone)
-    if not normalized:
-        await message.answer("Пожалуйста, укажите номер телефона в формате +7XXXXXXXXXX (можно 8XXXXXXXXXX).")
-        return
+async def _finish_survey(tenant: Tenant, funnel: SurveyFunnel, data: dict, state: FSMContext,
+                         user_id: int | None, message: Message) -> None:
+    # Лид пишется в локальное хранилище, в таблицу арендатора он уйдёт в фоне
+    await save_lead(tenant, user_id, data, complete=True)
+    # Отменяем отложенное сохранение, анкета завершена
+    if user_id:
+        await cancel_partial_save(tenant, user_id)
 
-    await state.update_data(phone=normalized)
-    data = await state.get_data()
-    try:
-        sheet.append_row([
-            data.get("name", ""),
-            data.get("username", ""),
-            data.get("budget", ""),
-            data.get("goal", ""),
-            data.get("timing", ""),
-            data.get("phone", ""),
-        ])
-    except Exception:
-        pass
+    # Уведомление админам о завершении анкеты уходит в фоне
+    notify_admins(message.bot, _lead_summary("Новая анкета", data))
 
-    # Уведомление админам о завершении анкеты
-    try:
-        summary = (
-            "Новая анкета:\n"
-            f"Имя: {data.get('name','')}\n"
-            f"Логин: {data.get('username','')}\n"
-            f"Бюджет: {data.get('budget','')}\n"
-            f"Цель: {data.get('goal','')}\n"
-            f"Сроки: {data.get('timing','')}\n"
-            f"Телефон: {data.get('phone','')}"
-        )
-        await notify_admins(message.bot, summary)
-    except Exception:
-        pass
-
-    await message.answer(
-            "Спасибо за ответы! 🙏\n\n"
-            "Подписывайтесь на мой <a href=\"https://t.me/Broker_9Avenu\">КАНАЛ</a> и будете в курсе новостей и рынка ☝️\n\n"
-            "💌 Задать вопрос лично можно <a href=\"https://t.me/uu_promore\">здесь</a>\n\n"
-            "Я уже подготовила для вас персонализированную презентацию с лучшими предложениями.\n\n"
-            "📎 Скачивайте презентацию и изучайте предложения!"
-    )
+    await message.answer(funnel.done)
     # Отправляем PDF следующим сообщением, исходя из выбранной цели
-    goal_value = data.get("goal")
-    pdf_path = get_pdf_path_for_goal(goal_value)
+    pdf_path = tenant.pdf_routes.resolve(data.get("goal"))
     try:
-        if not pdf_path.exists():
-            # Фоллбэк к дефолтному, если указанного файла нет
-            fallback = Path("data/презентация.pdf")
-            if fallback.exists():
-                pdf_path = fallback
-        if pdf_path.exists():
-            await message.answer_document(document=FSInputFile(str(pdf_path)))
+        if pdf_path:
+            await send_cached_media(tenant.media_cache, pdf_path, lambda document: message.answer_document(document=document))
     except Exception:
-        pass
-    # Отменяем отложенное сохранение, анкета завершена
-    if message.from_user and message.from_user.id:
-        cancel_partial_save(message.from_user.id)
+        SUPPRESSED_ERRORS.inc("pdf_send")
+        logging.exception("Не удалось отправить PDF пользователю")
     await state.clear()
 
+async def survey_answer(message: Message, state: FSMContext, tenant: Tenant, raw_state: str | None = None):
+    found = tenant.survey.step_for(raw_state)
+    if found is None:
+        return
+    funnel, step = found
+    if step.options:
+        # На этом шаге ждём нажатия кнопки
+        return
+    value = step.validate(message.text or "")
+    if value is None:
+        await message.answer(step.error)
+        return
+    user_id = message.from_user.id if message.from_user else None
+    await _advance_survey(tenant, funnel, step, value, state, user_id, message, edit=False)
+
+async def survey_choice(cq: CallbackQuery, callback_data: SurveyChoice, state: FSMContext, tenant: Tenant,
+                        raw_state: str | None = None):
+    found = tenant.survey.step_for(raw_state)
+    value = None
+    if found is not None and found[1].options and found[1].index == callback_data.q:
+        value = found[1].options.label(callback_data.i)
+    if value is None:
+        # Кнопка от другого шага или старого сообщения
+        await cq.answer()
+        return
+    funnel, step = found
+    await _advance_survey(tenant, funnel, step, value, state, cq.from_user.id, cq.message, edit=True)
+    await cq.answer()
+
  
 
  
 
+# --- Защита от флуда ---
+# Токен-бакеты: на пользователя (rate обновлений в секунду, запас burst) и общий на бота.
+# 0 в *_RATE отключает соответствующий лимит.
+THROTTLE_USER_RATE = float(os.getenv("THROTTLE_USER_RATE", "1"))
+THROTTLE_USER_BURST = float(os.getenv("THROTTLE_USER_BURST", "8"))
+THROTTLE_GLOBAL_RATE = float(os.getenv("THROTTLE_GLOBAL_RATE", "60"))
+THROTTLE_GLOBAL_BURST = float(os.getenv("THROTTLE_GLOBAL_BURST", "300"))
+# /start дороже остальных обновлений: фото, сброс анкеты, новый таймер автосохранения
+THROTTLE_START_COST = float(os.getenv("THROTTLE_START_COST", "3"))
+# Сколько пользователей помнить; дольше всех молчавшие вытесняются первыми
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS", "100000"))
+THROTTLE_TEXT = "Слишком много запросов, подождите немного 🙏"
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Отбрасывает лишние сообщения и нажатия до фильтров и хендлеров; подключается как outer-middleware.
+
+    Вытесненный из LRU пользователь получает полный бакет — так же, как если бы
+    он молчал достаточно долго, поэтому ограничение памяти не ослабляет лимит.
+    Личный лимит считается отдельно в каждом боте, общий — на весь процесс.
+    """
+
+    def __init__(self, user_rate: float = THROTTLE_USER_RATE, user_burst: float = THROTTLE_USER_BURST,
+                 global_rate: float = THROTTLE_GLOBAL_RATE, global_burst: float = THROTTLE_GLOBAL_BURST,
+                 max_users: int = THROTTLE_MAX_USERS):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.max_users = max_users
+        self._users: OrderedDict[tuple[int, int], _TokenBucket] = OrderedDict()
+        self._global = _TokenBucket(global_burst, time.monotonic())
+
+    def tracked(self) -> int:
+        return len(self._users)
+
+    def _user_bucket(self, key: tuple[int, int], now: float) -> _TokenBucket:
+        bucket = self._users.get(key)
+        if bucket is not None:
+            self._users.move_to_end(key)
+            return bucket
+        bucket = self._users[key] = _TokenBucket(self.user_burst, now)
+        if len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return bucket
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or data["tenant"].is_admin(user.id):
+            return await handler(event, data)
+        now = time.monotonic()
+        bucket = None
+        if self.user_rate > 0:
+            cost = THROTTLE_START_COST if isinstance(event, Message) and (event.text or "").startswith("/start") else 1.0
+            bucket = self._user_bucket((data["bot"].id, user.id), now)
+            if not bucket.take(cost, self.user_rate, self.user_burst, now):
+                THROTTLED_UPDATES.inc("user")
+                await self._reject(event, bucket)
+                return None
+        # Общий лимит проверяется после личного: флудер не расходует общий запас
+        if self.global_rate > 0 and not self._global.take(1.0, self.global_rate, self.global_burst, now):
+            THROTTLED_UPDATES.inc("global")
+            if isinstance(event, CallbackQuery):
+                await self._answer(event)
+            return None
+        if bucket is not None:
+            bucket.warned = False
+        return await handler(event, data)
+
+    async def _reject(self, event, bucket: _TokenBucket) -> None:
+        if bucket.warned:
+            # Нажатие без ответа оставит «часики» на кнопке, но не стоит запроса на каждое
+            return
+        bucket.warned = True
+        await self._answer(event, THROTTLE_TEXT)
+
+    async def _answer(self, event, text: str | None = None) -> None:
+        # Нажатию нужен ответ хотя бы без текста, иначе на кнопке остаются «часики»
+        if text is None and not isinstance(event, CallbackQuery):
+            return
+        try:
+            await event.answer(text)
+        except Exception:
+            SUPPRESSED_ERRORS.inc("throttle_reply")
+
+throttling = ThrottlingMiddleware()
+metrics.register(Gauge("throttle_tracked_users", "Пользователи в таблице антифлуда", throttling.tracked))
+
 # --- Запуск ---
-async def main():
-    bot = Bot(TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    dp = Dispatcher()
+# polling — long polling (по умолчанию), webhook — aiohttp-сервер для приёма обновлений
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+# Свой Bot API сервер (например, заглушка из bench.py для локальной проверки)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Сколько обновлений обрабатывается одновременно в режиме webhook
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "100"))
+HEALTH_PATH = os.getenv("HEALTH_PATH", "/healthz")
+# Сколько ждать завершения обрабатываемых обновлений при остановке
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+# Цель по холодному старту: секунд от запуска процесса до приёма обновлений.
+# Большую часть занимает импорт aiogram (модели pydantic) — около 3–4,5 с на слабой машине;
+# подключение к Google и прочее сетевое в старт не входит. bench.py падает, если цель не достигнута.
+COLD_START_TARGET = float(os.getenv("COLD_START_TARGET", "6"))
+
+def report_cold_start() -> float:
+    elapsed = time.monotonic() - STARTED_AT
+    if elapsed > COLD_START_TARGET:
+        logging.warning("Холодный старт %.2f с — больше цели %.2f с", elapsed, COLD_START_TARGET)
+    else:
+        logging.info("Холодный старт %.2f с (цель %.2f с)", elapsed, COLD_START_TARGET)
+    return elapsed
+
+class UpdateGate(BaseMiddleware):
+    """Считает обновления в обработке и при необходимости ограничивает их число."""
+
+    def __init__(self, limit: int | None = None):
+        self._semaphore: asyncio.Semaphore | None = None
+        self.set_limit(limit)
+        self._inflight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def set_limit(self, limit: int | None) -> None:
+        self._semaphore = asyncio.Semaphore(limit) if limit else None
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    async def __call__(self, handler, event, data):
+        self._inflight += 1
+        self._idle.clear()
+        try:
+            if self._semaphore is None:
+                return await handler(event, data)
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self._inflight -= 1
+            if self._inflight == 0:
+                self._idle.set()
+
+    async def drain(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("Остановка: не дождались завершения %d обновлений", self._inflight)
+
+update_gate = UpdateGate()
+metrics.register(Gauge("bot_updates_inflight", "Обновления в обработке", lambda: update_gate.inflight))
+
+def create_bots() -> list[Bot]:
+    """Боты всех арендаторов; у них одна HTTP-сессия, а значит и один пул соединений."""
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        session = AiohttpSession()
+    # Очередь — снаружи: метрики запросов видят каждую попытку, а не время в очереди
+    session.middleware(send_shaper)
+    session.middleware(TelegramMetricsMiddleware())
+    default = DefaultBotProperties(parse_mode=ParseMode.HTML)
+    for tenant in tenants.all():
+        if not tenant.token:
+            raise RuntimeError(f"У арендатора '{tenant.name}' не задан токен бота (token / token_env)")
+    return [tenants.bind(tenant, Bot(tenant.token, session=session, default=default)) for tenant in tenants.all()]
 
-    # Убедимся, что в таблице есть первая строка с заголовками
-    ensure_sheet_headers()
+def build_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=fsm_storage)
+    dp.update.outer_middleware(update_gate)
+    dp.update.outer_middleware(TenantMiddleware())
+    dp.message.outer_middleware(throttling)
+    dp.callback_query.outer_middleware(throttling)
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
 
     # Регистрация обработчиков только для простой анкеты
     dp.message.register(cmd_start, F.text == "/start")
-    dp.message.register(survey_name, Survey.name)
-    dp.callback_query.register(on_budget_selected, F.data.startswith("budget:"), Survey.budget)
-    dp.callback_query.register(on_goal_selected, F.data.startswith("goal:"), Survey.goal)
-    dp.callback_query.register(on_timing_selected, F.data.startswith("timing:"), Survey.timing)
-    dp.message.register(survey_phone, Survey.phone)
+    # Все шаги анкеты обслуживают два общих обработчика, шаг определяется по состоянию
+    dp.message.register(survey_answer, in_survey)
+    dp.callback_query.register(survey_choice, SurveyChoice.filter(), in_survey)
     # Админ: настройка PDF по целям
     dp.message.register(admin_pdf_start, F.text == "/pdf")
-    dp.callback_query.register(on_pdf_goal_selected, F.data.startswith("pdfgoal:"), PdfSetup.choose_goal)
+    dp.message.register(admin_pdf_rollback, F.text.startswith("/pdf_rollback"))
+    dp.callback_query.register(on_pdf_goal_selected, PdfGoalChoice.filter(), PdfSetup.choose_goal)
     dp.message.register(admin_pdf_receive_document, PdfSetup.waiting_file)
+    return dp
+
+_metrics_runner: web.AppRunner | None = None
+
+async def start_services() -> None:
+    """Запускает общие сервисы и готовит арендаторов; боты уже созданы create_bots()."""
+    global _metrics_runner
+    _metrics_runner = await start_metrics_server()
+    for tenant in tenants.all():
+        # Подключение к Google идёт в фоне и не задерживает старт
+        tenant.sheets.on_ready(functools.partial(sheet_writer.wake, tenant.name))
+        tenant.sheets.start()
+        tenant.survey.load()
+        tenant.media_cache.load()
+        tenant.pdf_routes.reload()
+    # Лиды сначала пишутся локально, в таблицу их переносит фоновый воркер
+    await lead_store.open()
+    await fsm_storage.open()
+    for tenant in tenants.all():
+        await tenant.index.load()
+    sheet_writer.start()
+    send_shaper.start()
+    admin_notifier.start()
+    for tenant in tenants.all():
+        await recover_pending_partials(tenant)
+    partial_saves.start()
+
+async def stop_services() -> None:
+    global _metrics_runner
+    # Порядок важен: таймеры могут породить лиды и уведомления, поэтому они первые
+    await partial_saves.stop()
+    await pdf_uploads.stop()
+    await admin_notifier.stop()
+    await send_shaper.stop()
+    await sheet_writer.stop()
+    for tenant in tenants.all():
+        await tenant.sheets.stop()
+    await fsm_storage.close()
+    await lead_store.close()
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+
+async def run_polling(bots: list[Bot]) -> None:
+    dp = build_dispatcher()
+    dp.startup.register(report_cold_start)
+    await start_services()
+    try:
+        await dp.start_polling(*bots, close_bot_session=False)
+    finally:
+        await update_gate.drain(SHUTDOWN_DRAIN_TIMEOUT)
+        await stop_services()
+        # Сессия общая для всех ботов
+        await bots[0].session.close()
+
+async def run_webhook(bots: list[Bot]) -> None:
+    if not WEBHOOK_BASE_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_BASE_URL")
+    # Без секрета любой, кто знает адрес, мог бы присылать боту поддельные обновления
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_SECRET")
+    update_gate.set_limit(WEBHOOK_WORKERS)
+    dp = build_dispatcher()
+    app = web.Application()
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok", "inflight": update_gate.inflight, "pending_partials": partial_saves.pending()})
+
+    async def on_startup(app: web.Application) -> None:
+        await start_services()
+        allowed_updates = dp.resolve_used_update_types()
+        for tenant in tenants.all():
+            await tenant.bot.set_webhook(
+                url=WEBHOOK_BASE_URL + tenant.webhook_path,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=allowed_updates,
+            )
+
+    async def on_shutdown(app: web.Application) -> None:
+        # Сначала дожидаемся хендлеров и очередей, и только потом обработчики вебхука закроют сессию ботов
+        await update_gate.drain(SHUTDOWN_DRAIN_TIMEOUT)
+        await stop_services()
+
+    app.router.add_get(HEALTH_PATH, health)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    # У каждого арендатора свой путь: по нему понятно, какому боту пришло обновление
+    for tenant in tenants.all():
+        SimpleRequestHandler(dispatcher=dp, bot=tenant.bot, secret_token=WEBHOOK_SECRET).register(app, path=tenant.webhook_path)
 
-    await dp.start_polling(bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logging.info("Webhook-сервер слушает %s:%s%s (арендаторов: %d)", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, len(bots))
+    report_cold_start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop_event.wait()
+    finally:
+        await runner.cleanup()
+
+async def main():
+    bots = create_bots()
+    if BOT_MODE == "webhook":
+        await run_webhook(bots)
+    else:
+        await run_polling(bots)
 
 if __name__ == "__main__":
     asyncio.run(main())
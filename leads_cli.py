@@ -0,0 +1,208 @@
+"""Выгрузка и аналитика лидов из локального хранилища — без обращения к Google Sheets.
+
+Читает ту же базу, что и бот (LEAD_STORE_DSN / LEAD_STORE_PATH). Выгрузка идёт потоково,
+пачками по --chunk строк, поэтому память не растёт с размером базы; stats считает сама база.
+
+    python leads_cli.py export --out leads.csv
+    python leads_cli.py export --format parquet --out leads.parquet   # нужен pyarrow
+    python leads_cli.py stats
+    python leads_cli.py stats --since 2026-01-01 --json
+    python leads_cli.py stats --tenant broker1                         # один арендатор из tenants.json
+    python leads_cli.py resend                                         # вернуть в очередь отклонённые таблицей лиды
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+from collections import Counter
+from datetime import datetime
+from itertools import product
+
+import bot
+
+EXPORT_COLUMNS = ("key", "tenant", "user_id", "complete", "created_at", "updated_at") + bot.LEAD_FIELDS
+# Шаги воронки: какое поле заполняется на каком шаге. Лид появляется только после /start,
+# поэтому start — это все лиды (username пуст у пользователей без @логина)
+FUNNEL_STEPS = (("start", None), ("name", "name"), ("budget", "budget"),
+                ("goal", "goal"), ("timing", "timing"), ("phone", "phone"))
+
+
+def _parse_since(value: str | None) -> float:
+    return datetime.fromisoformat(value).timestamp() if value else 0.0
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts).isoformat(timespec="seconds")
+
+
+def _columns(chunk: list[tuple]) -> dict[str, list]:
+    """Превращает пачку строк базы в столбцы."""
+    keys, user_ids, fields, complete, created, updated, tenants = zip(*chunk)
+    parsed = [json.loads(raw) for raw in fields]
+    columns = {
+        "key": list(keys),
+        "tenant": list(tenants),
+        "user_id": list(user_ids),
+        "complete": [bool(c) for c in complete],
+        "created_at": [_iso(ts) for ts in created],
+        "updated_at": [_iso(ts) for ts in updated],
+    }
+    for name in bot.LEAD_FIELDS:
+        columns[name] = [f.get(name, "") for f in parsed]
+    return columns
+
+
+class CsvSink:
+    def __init__(self, path: str):
+        self._file = open(path, "w", encoding="utf-8", newline="") if path != "-" else sys.stdout
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(EXPORT_COLUMNS)
+
+    def write(self, columns: dict[str, list]) -> None:
+        self._writer.writerows(zip(*(columns[name] for name in EXPORT_COLUMNS)))
+
+    def close(self) -> None:
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+class ParquetSink:
+    """Каждая пачка — отдельная row group; pyarrow — необязательная зависимость."""
+
+    def __init__(self, path: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Для выгрузки в Parquet установите pyarrow: pip install pyarrow")
+        self._pa = pa
+        self._schema = pa.schema(
+            [("key", pa.string()), ("tenant", pa.string()), ("user_id", pa.int64()), ("complete", pa.bool_()),
+             ("created_at", pa.string()), ("updated_at", pa.string())]
+            + [(name, pa.string()) for name in bot.LEAD_FIELDS]
+        )
+        self._writer = pq.ParquetWriter(path, self._schema)
+
+    def write(self, columns: dict[str, list]) -> None:
+        self._writer.write_table(self._pa.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self) -> None:
+        self._writer.close()
+
+
+async def export(args) -> None:
+    sink = ParquetSink(args.out) if args.format == "parquet" else CsvSink(args.out)
+    total = 0
+    try:
+        async for chunk in bot.lead_store.iter_leads(args.chunk, _parse_since(args.since), args.tenant):
+            sink.write(_columns(chunk))
+            total += len(chunk)
+    finally:
+        sink.close()
+    print(f"Выгружено лидов: {total}", file=sys.stderr)
+
+
+async def stats(args) -> None:
+    total = complete = 0
+    funnel: Counter = Counter()
+    segments: Counter = Counter()
+    for_segments = ("budget", "goal", "timing")
+    # Одна строка на сегмент, лиды не разбираются в Python; поля сегмента считаются по сегментам
+    filled = tuple(field for _, field in FUNNEL_STEPS if field is not None and field not in for_segments)
+    rows = await bot.lead_store.lead_stats(_parse_since(args.since), args.tenant, for_segments, filled)
+    for row in rows:
+        combo, (count, done, *counts) = tuple(row[:len(for_segments)]), row[len(for_segments):]
+        total += count
+        complete += done
+        segments[combo] += count
+        funnel.update(dict(zip(filled, counts)))
+        funnel.update({name: count for name, value in zip(for_segments, combo) if value})
+    # Шаг без поля (start) — это все лиды
+    funnel = Counter({step: total if field is None else funnel[field] for step, field in FUNNEL_STEPS})
+
+    # Все сочетания вариантов из анкет (по всем воронкам), включая пустые, плюс неожиданные значения
+    known = list(product(*(_options(args.tenant, name) for name in for_segments)))
+    known_set = set(known)
+    extra = [combo for combo in segments if combo not in known_set]
+    table = [(combo, segments.get(combo, 0)) for combo in known + sorted(extra)]
+
+    if args.json:
+        print(json.dumps({
+            "total": total,
+            "complete": complete,
+            "funnel": {step: funnel[step] for step, _ in FUNNEL_STEPS},
+            "segments": [{"budget": b, "goal": g, "timing": t, "count": n} for (b, g, t), n in table],
+        }, ensure_ascii=False, indent=2))
+        return
+
+    print(f"Всего лидов: {total}, завершённых анкет: {complete}")
+    print("\nВоронка:")
+    for step, _ in FUNNEL_STEPS:
+        share = funnel[step] / total if total else 0.0
+        print(f"  {step:<8} {funnel[step]:>10} {share:>7.1%}")
+    print("\nБюджет × цель × сроки:")
+    for (budget, goal, timing), count in table:
+        if count or args.all:
+            print(f"  {count:>10}  {budget or '—'} | {goal or '—'} | {timing or '—'}")
+
+
+async def resend(args) -> None:
+    count = await bot.lead_store.resend_abandoned(bot.SHEET_MAX_DELIVERY_ATTEMPTS, args.tenant)
+    print(f"Возвращено в очередь лидов: {count}; бот отправит их в таблицу при следующей проверке", file=sys.stderr)
+
+
+COMMANDS = {"export": export, "stats": stats, "resend": resend}
+
+
+def _tenants(name: str | None) -> list:
+    if name is None:
+        return bot.tenants.all()
+    tenant = bot.tenants.get(name)
+    if tenant is None:
+        raise SystemExit(f"Нет арендатора '{name}'")
+    return [tenant]
+
+
+def _options(tenant: str | None, field: str) -> list[str]:
+    """Варианты ответа для поля по анкетам выбранных арендаторов, без повторов."""
+    labels: dict[str, None] = {}
+    for item in _tenants(tenant):
+        labels.update(dict.fromkeys(item.survey.options(field)))
+    return list(labels)
+
+
+async def run(args) -> None:
+    for tenant in _tenants(args.tenant):
+        tenant.survey.load()
+    await bot.lead_store.open()
+    try:
+        await COMMANDS[args.command](args)
+    finally:
+        await bot.lead_store.close()
+
+
+def main() -> None:
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--chunk", type=int, default=50_000, help="строк в пачке")
+    common.add_argument("--since", help="только лиды с этой даты (ISO, например 2026-01-01)")
+    common.add_argument("--tenant", help="только лиды этого арендатора (по умолчанию — все)")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_export = sub.add_parser("export", parents=[common], help="выгрузить лиды в CSV или Parquet")
+    p_export.add_argument("--format", choices=("csv", "parquet"), default="csv")
+    p_export.add_argument("--out", default="-", help="файл выгрузки (по умолчанию stdout для CSV)")
+    p_stats = sub.add_parser("stats", parents=[common], help="воронка и сегменты бюджет × цель × сроки")
+    p_stats.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    p_stats.add_argument("--all", action="store_true", help="показывать и пустые сегменты")
+    p_resend = sub.add_parser("resend", help="вернуть в очередь лиды, которые таблица отклонила "
+                                             "SHEET_MAX_DELIVERY_ATTEMPTS раз")
+    p_resend.add_argument("--tenant", help="только лиды этого арендатора (по умолчанию — все)")
+    args = parser.parse_args()
+    if args.command == "export" and args.format == "parquet" and args.out == "-":
+        parser.error("для Parquet укажите --out")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()